@@ -1,7 +1,17 @@
+import gzip
 import json
 import logging
-from datetime import datetime
+import os
+from datetime import date, datetime
 import pandas as pd
+import psycopg2
+
+AUDIT_PARTITIONS_AHEAD = 2
+AUDIT_RETENTION_MONTHS = int(os.getenv('AUDIT_RETENTION_MONTHS', '12'))
+AUDIT_ARCHIVE_DIR = os.getenv('AUDIT_ARCHIVE_DIR')
+AUDIT_MIGRATION_BATCH_SIZE = 10000
+# Key of the advisory lock that makes sure only one process migrates 'audit_logs_legacy' at a time
+AUDIT_MIGRATION_LOCK_ID = 3201
 
 def log_audit_event(cursor, user_id, action, table_name, record_id, old_values=None, new_values=None):
     logging.info(f"Audit log event: {action} on {table_name} (Record ID: {record_id}) by {user_id}.")
@@ -40,3 +50,337 @@ def log_audit_event(cursor, user_id, action, table_name, record_id, old_values=N
     except Exception as e:
         logging.error(f"Error logging audit event for {record_id}: {e}")
         cursor.connection.rollback()
+
+
+def month_start(moment, months_offset=0):
+    month_index = moment.year * 12 + moment.month - 1 + months_offset
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def audit_partition_name(start):
+    return f"audit_logs_p{start:%Y%m}"
+
+
+def create_audit_table(cursor, months_ahead=AUDIT_PARTITIONS_AHEAD):
+    """
+    Creates the 'audit_logs' table, range-partitioned by month on 'action_time', together with the partitions for
+    the current month and the next 'months_ahead' months. Rows outside those months land in a default partition.
+    A legacy unpartitioned 'audit_logs' table is renamed to 'audit_logs_legacy' first. Its rows are moved over by
+    migrate_legacy_audit_table, which runs as maintenance ('python audit.py' or the pipeline's 'audit' stage) and
+    not here, so writers never wait for the copy. Every process that writes audit events should call this on
+    startup, so the partition for the current month exists before its rows arrive.
+    """
+    try:
+        legacy_renamed = rename_legacy_audit_table(cursor)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS audit_logs (
+                id BIGSERIAL,
+                user_id TEXT,
+                action TEXT NOT NULL,
+                table_name TEXT NOT NULL,
+                record_id TEXT,
+                old_values JSONB,
+                new_values JSONB,
+                action_time TIMESTAMP NOT NULL DEFAULT NOW(),
+                PRIMARY KEY (id, action_time)
+            ) PARTITION BY RANGE (action_time);
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_audit_logs_record
+            ON audit_logs (table_name, record_id, action_time);
+        """)
+        cursor.execute("CREATE TABLE IF NOT EXISTS audit_logs_default PARTITION OF audit_logs DEFAULT;")
+        # Commit the rename together with the new parent, so writers never see a missing 'audit_logs'
+        cursor.connection.commit()
+        if legacy_renamed:
+            logging.warning("Renamed the unpartitioned 'audit_logs' table to 'audit_logs_legacy'. "
+                            "Run 'python audit.py' to move its rows into the partitioned table.")
+        ensure_audit_partitions(cursor, months_ahead)
+        logging.info("Table 'audit_logs' created or already exists.")
+    except psycopg2.Error as e:
+        logging.error(f"Error creating table 'audit_logs': {e}")
+        cursor.connection.rollback()
+
+
+def rename_legacy_audit_table(cursor):
+    """
+    Renames an unpartitioned 'audit_logs' table, created before the table was partitioned, to 'audit_logs_legacy'.
+    Runs in the caller's transaction, so the new partitioned parent can be created before anyone sees the rename.
+    :return: True if the table was renamed.
+    """
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('audit_logs');")
+    existing = cursor.fetchone()
+    if not existing or existing[0] == 'p':
+        return False
+
+    # Another process may have migrated the table while this one waited for the lock
+    cursor.execute("LOCK TABLE audit_logs IN ACCESS EXCLUSIVE MODE;")
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('audit_logs');")
+    existing = cursor.fetchone()
+    if not existing or existing[0] == 'p':
+        return False
+    cursor.execute("ALTER TABLE audit_logs RENAME TO audit_logs_legacy;")
+    return True
+
+
+def migrate_legacy_audit_table(cursor, batch_size=AUDIT_MIGRATION_BATCH_SIZE):
+    """
+    Moves the rows of 'audit_logs_legacy' into the partitioned 'audit_logs' and drops the legacy table once it is
+    empty. First creates the monthly partitions for the months the legacy rows cover. Rows are moved in batches
+    of 'batch_size', each in its own short transaction, so concurrent writers are never blocked for long and an
+    interrupted migration continues where it stopped on the next call. Only the columns both tables have are
+    copied, cast to the types of the partitioned table; IDs are kept and the ID sequence is moved past them.
+    An advisory lock keeps a second process from migrating at the same time; that process returns right away.
+    :return: Number of moved rows.
+    """
+    cursor.execute("SELECT to_regclass('audit_logs_legacy') IS NOT NULL;")
+    if not cursor.fetchone()[0]:
+        cursor.connection.commit()
+        return 0
+
+    cursor.execute("SELECT pg_try_advisory_lock(%s);", (AUDIT_MIGRATION_LOCK_ID,))
+    if not cursor.fetchone()[0]:
+        cursor.connection.commit()
+        logging.info("Another process is migrating 'audit_logs_legacy', skipping.")
+        return 0
+
+    moved_rows = 0
+    try:
+        # The previous holder of the lock may have finished the migration in the meantime
+        cursor.execute("SELECT to_regclass('audit_logs_legacy') IS NOT NULL;")
+        if not cursor.fetchone()[0]:
+            cursor.connection.commit()
+            return 0
+
+        cursor.execute("""
+            SELECT parent.column_name, parent.data_type
+            FROM information_schema.columns parent
+            JOIN information_schema.columns legacy
+              ON legacy.column_name = parent.column_name
+             AND legacy.table_schema = parent.table_schema AND legacy.table_name = 'audit_logs_legacy'
+            WHERE parent.table_name = 'audit_logs' AND parent.table_schema = current_schema()
+            ORDER BY parent.ordinal_position;
+        """)
+        columns = cursor.fetchall()
+        column_names = [name for name, _ in columns]
+        if 'action_time' not in column_names:
+            logging.error("Table 'audit_logs_legacy' has no 'action_time' column, migrate it manually.")
+            cursor.connection.rollback()
+            return 0
+
+        cursor.execute("SELECT MIN(action_time) FROM audit_logs_legacy;")
+        oldest = cursor.fetchone()[0]
+        if oldest is not None:
+            create_audit_partitions(cursor, month_start(oldest), month_start(date.today(), 1))
+        if 'id' in column_names:
+            cursor.execute("""
+                SELECT setval(pg_get_serial_sequence('audit_logs', 'id'),
+                              GREATEST(MAX(id), nextval(pg_get_serial_sequence('audit_logs', 'id'))))
+                FROM audit_logs_legacy;
+            """)
+        cursor.connection.commit()
+
+        target_columns = ', '.join(column_names)
+        source_columns = ', '.join(
+            f"COALESCE({name}, NOW())::timestamp" if name == 'action_time' else f"{name}::{data_type}"
+            for name, data_type in columns
+        )
+        while True:
+            cursor.execute(f"""
+                WITH moved AS (
+                    DELETE FROM audit_logs_legacy
+                    WHERE ctid = ANY(ARRAY(SELECT ctid FROM audit_logs_legacy LIMIT %s))
+                    RETURNING *
+                )
+                INSERT INTO audit_logs ({target_columns})
+                SELECT {source_columns} FROM moved;
+            """, (batch_size,))
+            batch_rows = cursor.rowcount
+            cursor.connection.commit()
+            moved_rows += batch_rows
+            if batch_rows < batch_size:
+                # Only drop the table once it is verifiably empty, with nobody able to add or hold rows
+                cursor.execute("LOCK TABLE audit_logs_legacy IN ACCESS EXCLUSIVE MODE;")
+                cursor.execute("SELECT NOT EXISTS (SELECT 1 FROM audit_logs_legacy);")
+                if cursor.fetchone()[0]:
+                    cursor.execute("DROP TABLE audit_logs_legacy;")
+                    cursor.connection.commit()
+                    break
+                cursor.connection.rollback()
+            logging.info(f"Moved {moved_rows} rows from 'audit_logs_legacy' to 'audit_logs' so far.")
+
+        logging.info(f"Migrated {moved_rows} legacy audit rows into the partitioned 'audit_logs' table.")
+    except psycopg2.Error as e:
+        logging.error(f"Error migrating 'audit_logs_legacy' after {moved_rows} rows: {e}")
+        cursor.connection.rollback()
+    finally:
+        cursor.execute("SELECT pg_advisory_unlock(%s);", (AUDIT_MIGRATION_LOCK_ID,))
+        cursor.connection.commit()
+    return moved_rows
+
+
+def ensure_audit_partitions(cursor, months_ahead=AUDIT_PARTITIONS_AHEAD):
+    """
+    Creates the monthly partitions of 'audit_logs' from the current month up to 'months_ahead' months ahead.
+    """
+    today = date.today()
+    create_audit_partitions(cursor, month_start(today), month_start(today, months_ahead + 1))
+
+
+def create_audit_partitions(cursor, first_month, end_month):
+    """
+    Creates the missing monthly partitions of 'audit_logs' for the months from 'first_month' up to, but not
+    including, 'end_month'. Rows of such a month that already landed in the default partition are moved into the
+    new partition in the same transaction, since Postgres refuses to create a partition whose rows are still in
+    the default partition.
+    """
+    start = first_month
+    while start < end_month:
+        end = month_start(start, 1)
+        partition_name = audit_partition_name(start)
+        try:
+            cursor.execute("SELECT to_regclass(%s) IS NOT NULL;", (partition_name,))
+            if not cursor.fetchone()[0]:
+                cursor.execute("""
+                    SELECT EXISTS (SELECT 1 FROM audit_logs_default WHERE action_time >= %s AND action_time < %s);
+                """, (start, end))
+                if cursor.fetchone()[0]:
+                    move_default_audit_rows(cursor, partition_name, start, end)
+                else:
+                    cursor.execute(f"""
+                        CREATE TABLE IF NOT EXISTS {partition_name}
+                        PARTITION OF audit_logs FOR VALUES FROM ('{start}') TO ('{end}');
+                    """)
+            cursor.connection.commit()
+        except psycopg2.Error as e:
+            logging.error(f"Error creating audit partition for {start:%Y-%m}: {e}")
+            cursor.connection.rollback()
+        start = end
+
+
+def move_default_audit_rows(cursor, partition_name, start, end):
+    """
+    Creates the partition for [start, end) as a standalone table, moves the matching rows of the default partition
+    into it and attaches it. Runs in the caller's transaction.
+    """
+    cursor.execute(f"CREATE TABLE {partition_name} (LIKE audit_logs INCLUDING DEFAULTS INCLUDING CONSTRAINTS);")
+    cursor.execute(f"""
+        WITH moved AS (
+            DELETE FROM audit_logs_default WHERE action_time >= %s AND action_time < %s
+            RETURNING *
+        )
+        INSERT INTO {partition_name} SELECT * FROM moved;
+    """, (start, end))
+    logging.info(f"Moved {cursor.rowcount} audit rows from the default partition to {partition_name}.")
+    cursor.execute(f"""
+        ALTER TABLE audit_logs ATTACH PARTITION {partition_name} FOR VALUES FROM ('{start}') TO ('{end}');
+    """)
+
+
+def list_audit_partitions(cursor):
+    """
+    Returns the monthly partitions of 'audit_logs' as (partition name, first day of the month) tuples, oldest first.
+    """
+    cursor.execute("""
+        SELECT child.relname
+        FROM pg_inherits i
+        JOIN pg_class parent ON parent.oid = i.inhparent
+        JOIN pg_class child ON child.oid = i.inhrelid
+        WHERE parent.relname = 'audit_logs';
+    """)
+    partitions = []
+    for (name,) in cursor.fetchall():
+        suffix = name[len('audit_logs_p'):]
+        if name.startswith('audit_logs_p') and suffix.isdigit() and len(suffix) == 6:
+            partitions.append((name, date(int(suffix[:4]), int(suffix[4:]), 1)))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def archive_audit_partition(cursor, partition_name, archive_dir):
+    """
+    Writes a partition to a gzip-compressed CSV file in 'archive_dir' before it is dropped.
+    :return: Path of the archive file.
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    archive_path = os.path.join(archive_dir, f"{partition_name}.csv.gz")
+    with gzip.open(archive_path, 'wb') as archive_file:
+        cursor.copy_expert(f"COPY {partition_name} TO STDOUT WITH (FORMAT csv, HEADER)", archive_file)
+    return archive_path
+
+
+def drop_expired_audit_partitions(cursor, retention_months=AUDIT_RETENTION_MONTHS, archive_dir=AUDIT_ARCHIVE_DIR):
+    """
+    Drops the monthly partitions of 'audit_logs' that lie completely before the retention period. Dropping a
+    partition is instant and leaves no dead rows behind, unlike DELETE. With 'archive_dir' set, every partition is
+    first exported to a compressed file.
+    :return: List of dropped partition names.
+    """
+    cutoff = month_start(date.today(), -retention_months)
+    dropped = []
+    for partition_name, start in list_audit_partitions(cursor):
+        if month_start(start, 1) > cutoff:
+            break
+        try:
+            if archive_dir:
+                archive_path = archive_audit_partition(cursor, partition_name, archive_dir)
+                logging.info(f"Archived audit partition {partition_name} to {archive_path}.")
+            cursor.execute(f"ALTER TABLE audit_logs DETACH PARTITION {partition_name};")
+            cursor.execute(f"DROP TABLE {partition_name};")
+            cursor.connection.commit()
+            dropped.append(partition_name)
+        except (psycopg2.Error, OSError) as e:
+            logging.error(f"Error dropping audit partition {partition_name}: {e}")
+            cursor.connection.rollback()
+            break
+
+    logging.info(f"Dropped {len(dropped)} audit partitions older than {cutoff}.")
+    purge_expired_default_rows(cursor, cutoff, archive_dir)
+    return dropped
+
+
+def purge_expired_default_rows(cursor, cutoff, archive_dir=AUDIT_ARCHIVE_DIR):
+    """
+    Deletes the rows of the default partition from before 'cutoff'. These are rows of months that had no partition
+    when they were written, which partition retention never drops. The default partition only ever holds such
+    stragglers, so a DELETE is cheap here. With 'archive_dir' set, the rows are first exported to a compressed file.
+    :return: Number of deleted rows.
+    """
+    try:
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM audit_logs_default WHERE action_time < %s);", (cutoff,))
+        if not cursor.fetchone()[0]:
+            cursor.connection.commit()
+            return 0
+        if archive_dir:
+            os.makedirs(archive_dir, exist_ok=True)
+            archive_path = os.path.join(archive_dir, f"audit_logs_default_{datetime.now():%Y%m%d%H%M%S}.csv.gz")
+            query = cursor.mogrify("SELECT * FROM audit_logs_default WHERE action_time < %s", (cutoff,)).decode()
+            with gzip.open(archive_path, 'wb') as archive_file:
+                cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)", archive_file)
+            logging.info(f"Archived expired rows of the default audit partition to {archive_path}.")
+        cursor.execute("DELETE FROM audit_logs_default WHERE action_time < %s;", (cutoff,))
+        deleted_rows = cursor.rowcount
+        cursor.connection.commit()
+        logging.info(f"Deleted {deleted_rows} rows older than {cutoff} from the default audit partition.")
+        return deleted_rows
+    except (psycopg2.Error, OSError) as e:
+        logging.error(f"Error purging the default audit partition: {e}")
+        cursor.connection.rollback()
+        return 0
+
+
+if __name__ == "__main__":
+    from connection import connect_to_postgres, close_connection
+
+    conn = connect_to_postgres()
+    if not conn:
+        logging.error("Failed to connect to PostgreSQL.")
+        exit()
+
+    try:
+        cursor = conn.cursor()
+        create_audit_table(cursor)
+        migrate_legacy_audit_table(cursor)
+        drop_expired_audit_partitions(cursor)
+        cursor.close()
+    finally:
+        close_connection(conn)
@@ -4,6 +4,7 @@ import psycopg2
 import logging
 from dotenv import load_dotenv
 import os
+import uuid
 
 from audit import log_audit_event
 
@@ -13,13 +14,26 @@ load_dotenv()
 # Set up logging for database actions and errors
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Base retry delay in hours for videos whose transcript could not be fetched, by failure reason
+TRANSCRIPT_RETRY_BASE_HOURS = {
+    'disabled': 24,
+    'unavailable': 24,
+    'error': 6,
+}
+TRANSCRIPT_RETRY_MAX_HOURS = 30 * 24
+CHUNK_SIZE = 50000
 
-def connect_to_postgres():
+
+def connect_to_postgres(sslmode=None):
+    """
+    :param sslmode: libpq SSL mode, e.g. 'require'. Defaults to POSTGRES_SSLMODE, or the libpq default when unset.
+    """
     db_host = os.getenv('POSTGRES_HOST')
     db_user = os.getenv('POSTGRES_USER')
     db_password = os.getenv('POSTGRES_PASSWORD')
     db_port = os.getenv('POSTGRES_PORT')
     db_name = os.getenv('POSTGRES_DB')
+    sslmode = sslmode or os.getenv('POSTGRES_SSLMODE')
 
     logging.info(f"Connecting to PostgreSQL with host: {db_host}, port: {db_port}, dbname: {db_name}, user: {db_user}")
 
@@ -29,7 +43,8 @@ def connect_to_postgres():
             port=db_port,
             dbname=db_name,
             user=db_user,
-            password=db_password
+            password=db_password,
+            sslmode=sslmode
         )
         logging.info(f"Successfully connected to PostgreSQL at {db_host}:{db_port}, database: {db_name}")
         return conn
@@ -47,6 +62,22 @@ def close_connection(conn):
             logging.error(f"Error closing the database connection: {e}")
 
 
+def stream_query(conn, query, params=None, chunk_size=CHUNK_SIZE):
+    """
+    Streams the result of a query in chunks using a server-side cursor, so a table is never held in memory at once.
+    :return: Generator of (column names, list of rows) tuples.
+    """
+    with conn.cursor(name=f"stream_{uuid.uuid4().hex}") as cursor:
+        cursor.itersize = chunk_size
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            columns = [desc[0] for desc in cursor.description]
+            yield columns, rows
+
+
 def create_fact_table(cursor):
     """
     Creates the fact table 'fact_video_metrics' for storing video metrics.
@@ -69,9 +100,38 @@ def create_fact_table(cursor):
         cursor.connection.rollback()
 
 
+def create_history_table(cursor):
+    """
+    Creates the table 'fact_video_metrics_history' holding a snapshot of the metrics every time they change.
+    """
+    try:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS fact_video_metrics_history (
+                video_id TEXT NOT NULL,
+                snapshot_date TIMESTAMP NOT NULL,
+                view_count INT,
+                like_count INT,
+                comment_count INT
+            );
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_history_video_snapshot
+            ON fact_video_metrics_history (video_id, snapshot_date);
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_history_snapshot_date
+            ON fact_video_metrics_history (snapshot_date);
+        """)
+        cursor.connection.commit()
+        logging.info("Table 'fact_video_metrics_history' created or already exists.")
+    except psycopg2.Error as e:
+        logging.error(f"Error creating table 'fact_video_metrics_history': {e}")
+        cursor.connection.rollback()
+
+
 def create_dimension_tables(cursor):
     """
-    Creates the dimension tables 'dim_video_info' and 'dim_transcripts'.
+    Creates the dimension tables 'dim_video_info', 'dim_tags', 'bridge_video_tags' and 'dim_transcripts'.
     """
     try:
         cursor.execute("""
@@ -83,8 +143,26 @@ def create_dimension_tables(cursor):
                 tags TEXT[]
             );
         """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_video_info_tags ON dim_video_info USING GIN (tags);")
         logging.info("Table 'dim_video_info' created or already exists.")
 
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS dim_tags (
+                tag_id SERIAL PRIMARY KEY,
+                tag TEXT NOT NULL UNIQUE
+            );
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS bridge_video_tags (
+                video_id TEXT NOT NULL REFERENCES dim_video_info (video_id) ON DELETE CASCADE,
+                tag_id INT NOT NULL REFERENCES dim_tags (tag_id),
+                PRIMARY KEY (video_id, tag_id)
+            );
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_bridge_video_tags_tag ON bridge_video_tags (tag_id, video_id);")
+        logging.info("Tables 'dim_tags' and 'bridge_video_tags' created or already exist.")
+        backfill_video_tags(cursor)
+
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS dim_transcripts (
                 video_id TEXT PRIMARY KEY,
@@ -99,6 +177,154 @@ def create_dimension_tables(cursor):
         cursor.connection.rollback()
 
 
+def backfill_video_tags(cursor):
+    """
+    Fills 'dim_tags' and 'bridge_video_tags' from the tag arrays in 'dim_video_info' when the bridge table is
+    still empty. After that, insert_video_info keeps them up to date incrementally.
+    """
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM bridge_video_tags);")
+    if cursor.fetchone()[0]:
+        return
+
+    cursor.execute("""
+        INSERT INTO dim_tags (tag)
+        SELECT DISTINCT unnest(tags) FROM dim_video_info
+        ON CONFLICT (tag) DO NOTHING;
+    """)
+    cursor.execute("""
+        INSERT INTO bridge_video_tags (video_id, tag_id)
+        SELECT DISTINCT v.video_id, t.tag_id
+        FROM dim_video_info v
+        CROSS JOIN LATERAL unnest(v.tags) AS u(tag)
+        JOIN dim_tags t ON t.tag = u.tag
+        ON CONFLICT DO NOTHING;
+    """)
+    logging.info(f"Backfilled {cursor.rowcount} video tags into 'bridge_video_tags'.")
+
+
+def sync_video_tags(cursor, video_id, old_tags, new_tags):
+    """
+    Applies the difference between the old and new tags of a video to 'dim_tags' and 'bridge_video_tags'.
+    """
+    old_tags = set(old_tags or [])
+    new_tags = set(new_tags or [])
+    removed_tags = list(old_tags - new_tags)
+    added_tags = list(new_tags - old_tags)
+
+    if removed_tags:
+        cursor.execute("""
+            DELETE FROM bridge_video_tags b
+            USING dim_tags t
+            WHERE b.tag_id = t.tag_id AND b.video_id = %s AND t.tag = ANY(%s);
+        """, (video_id, removed_tags))
+
+    if added_tags:
+        cursor.execute("""
+            INSERT INTO dim_tags (tag)
+            SELECT unnest(%s::text[])
+            ON CONFLICT (tag) DO NOTHING;
+        """, (added_tags,))
+        cursor.execute("""
+            INSERT INTO bridge_video_tags (video_id, tag_id)
+            SELECT %s, tag_id FROM dim_tags WHERE tag = ANY(%s)
+            ON CONFLICT DO NOTHING;
+        """, (video_id, added_tags))
+
+
+def fetch_videos_by_tag(cursor, tag):
+    """
+    Returns the IDs of the videos with the given tag, using the bridge table index.
+    """
+    cursor.execute("""
+        SELECT b.video_id
+        FROM dim_tags t
+        JOIN bridge_video_tags b ON b.tag_id = t.tag_id
+        WHERE t.tag = %s;
+    """, (tag,))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def fetch_top_tags_by_views(cursor, limit=20):
+    """
+    Returns the tags with the most total views as (tag, number of videos, total views) tuples.
+    """
+    cursor.execute("""
+        SELECT t.tag, COUNT(*) AS videos, SUM(f.view_count) AS total_views
+        FROM bridge_video_tags b
+        JOIN dim_tags t ON t.tag_id = b.tag_id
+        JOIN fact_video_metrics f ON f.video_id = b.video_id
+        GROUP BY t.tag
+        ORDER BY total_views DESC NULLS LAST
+        LIMIT %s;
+    """, (limit,))
+    return cursor.fetchall()
+
+
+def create_transcript_failures_table(cursor):
+    """
+    Creates the table 'transcript_failures', a negative cache of videos whose transcript could not be fetched
+    and the moment they may be retried.
+    """
+    try:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS transcript_failures (
+                video_id TEXT PRIMARY KEY,
+                reason TEXT NOT NULL,
+                attempts INT NOT NULL DEFAULT 1,
+                last_attempt TIMESTAMP NOT NULL,
+                next_retry_at TIMESTAMP NOT NULL
+            );
+        """)
+        cursor.connection.commit()
+        logging.info("Table 'transcript_failures' created or already exists.")
+    except psycopg2.Error as e:
+        logging.error(f"Error creating table 'transcript_failures': {e}")
+        cursor.connection.rollback()
+
+
+def record_transcript_failures(cursor, failures):
+    """
+    Stores failed transcript fetches in 'transcript_failures'. The retry delay starts at the base delay of the
+    failure reason and doubles with every further failed attempt, up to TRANSCRIPT_RETRY_MAX_HOURS.
+    Throttled fetches are not cached, since they say nothing about the video itself.
+    :param failures: Dictionary of video ID to failure reason.
+    """
+    rows = [
+        (video_id, reason, TRANSCRIPT_RETRY_BASE_HOURS[reason], TRANSCRIPT_RETRY_BASE_HOURS[reason],
+         TRANSCRIPT_RETRY_MAX_HOURS)
+        for video_id, reason in failures.items() if reason in TRANSCRIPT_RETRY_BASE_HOURS
+    ]
+    if not rows:
+        return
+
+    try:
+        cursor.executemany("""
+            INSERT INTO transcript_failures (video_id, reason, attempts, last_attempt, next_retry_at)
+            VALUES (%s, %s, 1, NOW(), NOW() + %s * INTERVAL '1 hour')
+            ON CONFLICT (video_id) DO UPDATE SET
+                reason = EXCLUDED.reason,
+                attempts = transcript_failures.attempts + 1,
+                last_attempt = NOW(),
+                next_retry_at = NOW() + LEAST(%s * POWER(2, transcript_failures.attempts), %s) * INTERVAL '1 hour';
+        """, rows)
+        cursor.connection.commit()
+        logging.info(f"Recorded {len(rows)} videos without transcript in 'transcript_failures'.")
+    except psycopg2.Error as e:
+        logging.error(f"Error recording transcript failures: {e}")
+        cursor.connection.rollback()
+
+
+def clear_transcript_failures(cursor, video_ids):
+    if not video_ids:
+        return
+    try:
+        cursor.execute("DELETE FROM transcript_failures WHERE video_id = ANY(%s);", (list(video_ids),))
+        cursor.connection.commit()
+    except psycopg2.Error as e:
+        logging.error(f"Error clearing transcript failures: {e}")
+        cursor.connection.rollback()
+
+
 def insert_video_metrics(cursor, videos_df, user_id="system"):
     if videos_df.empty:
         logging.warning("No video data to insert.")
@@ -214,11 +440,21 @@ def insert_video_info(cursor, videos_df, user_id="system"):
                     description = EXCLUDED.description,
                     category = EXCLUDED.category,
                     tags = EXCLUDED.tags
+                WHERE (dim_video_info.title, dim_video_info.description, dim_video_info.category, dim_video_info.tags)
+                    IS DISTINCT FROM (EXCLUDED.title, EXCLUDED.description, EXCLUDED.category, EXCLUDED.tags)
                 """,
                 (row['Video ID'], row['Title'], row['Description'], row['Category'], row['Tags'])
             )
             inserted_videos += 1
 
+            if cursor.rowcount == 0:
+                # Unchanged record: no new row version, no tag changes and nothing to audit
+                continue
+
+            old_tags = old_record[4] if old_record else []
+            if set(old_tags or []) != set(row['Tags'] or []):
+                sync_video_tags(cursor, row['Video ID'], old_tags, row['Tags'])
+
             log_audit_event(
                 cursor, user_id,
                 action="INSERT" if not old_record else "UPDATE",
@@ -5,81 +5,128 @@ import joblib
 import os
 from dotenv import load_dotenv
 import logging
-from audit import log_audit_event
+from audit import log_audit_event, create_audit_table
+from model_registry import latest_version, latest_artifact_path
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 load_dotenv()
 
-try:
-    model_dir = os.getenv('MODEL_DIR', 'models')
-    scaler = joblib.load(os.path.join(model_dir, 'scaler_ted_model_balanced.pkl'))
-    logging.info("Scaler model loaded successfully.")
-except Exception as e:
-    logging.error(f"Error loading scaler model: {e}")
-    exit(1)
-
-db_host = os.getenv('POSTGRES_HOST')
-db_user = os.getenv('POSTGRES_USER')
-db_password = os.getenv('POSTGRES_PASSWORD')
-db_port = os.getenv('POSTGRES_PORT')
-db_name = os.getenv('POSTGRES_DB')
-
-try:
-    with psycopg2.connect(
-            host=db_host,
-            port=db_port,
-            dbname=db_name,
-            user=db_user,
-            password=db_password,
-            sslmode='require'
-    ) as connection:
-        with connection.cursor() as cursor:
-            logging.info("Successfully connected to the database.")
-
-            video_data_query = "SELECT * FROM fact_video_metrics;"
-            video_data = pd.read_sql(video_data_query, connection)
-            logging.info(f"Fetched {len(video_data)} records from the database.")
-
-            if video_data.empty or 'view_count' not in video_data.columns:
-                logging.error("The 'view_count' column is missing or data is empty.")
-                exit(1)
-
-            # Feature engineering
-            video_data['log_views'] = np.log1p(video_data['view_count'])
-            video_data['log_likes'] = np.log1p(video_data['like_count'])
-            video_data['log_comments'] = np.log1p(video_data['comment_count'])
-            features_to_use = ['log_views', 'log_likes', 'log_comments']
-
-            df_scaled = scaler.transform(video_data[features_to_use])
-
-            popularity_threshold = np.percentile(video_data['view_count'], 60)
-            video_data['popularity'] = np.where(video_data['view_count'] >= popularity_threshold, 'Popular',
-                                                'Not Popular')
-            logging.info("Assigned popularity using the 60th percentile of view counts.")
-
-            cursor.execute("""CREATE TABLE IF NOT EXISTS dim_stats (
-                                video_id TEXT PRIMARY KEY,
-                                popularity TEXT NOT NULL
-                              );""")
-            connection.commit()
-
-            stats_data = video_data[['video_id', 'popularity']]
-            for index, row in stats_data.iterrows():
-                cursor.execute("SELECT * FROM dim_stats WHERE video_id = %s;", (row['video_id'],))
-                old_record = cursor.fetchone()
-                insert_query = """
-                    INSERT INTO dim_stats (video_id, popularity)
-                    VALUES (%s, %s)
-                    ON CONFLICT (video_id) DO UPDATE SET popularity = EXCLUDED.popularity;
-                """
-                cursor.execute(insert_query, (row['video_id'], row['popularity']))
-                log_audit_event(cursor, "system", "INSERT" if old_record is None else "UPDATE", "dim_stats",
-                                row['video_id'], old_record, row.to_dict())
-
-            connection.commit()
-            logging.info(f"Inserted popularity ratings for {len(stats_data)} videos into 'dim_stats' table.")
-
-except Exception as e:
-    logging.error(f"Unexpected error: {e}")
-finally:
-    logging.info("Database connection closed.")
+
+def fetch_video_metrics(connection):
+    video_data_query = "SELECT video_id, view_count, like_count, comment_count FROM fact_video_metrics;"
+    video_data = pd.read_sql(video_data_query, connection)
+    logging.info(f"Fetched {len(video_data)} records from the database.")
+    return video_data
+
+
+def load_popularity_model():
+    """
+    Loads the scaler and clustering of the latest popularity model retrained by train_models.py.
+    :return: Tuple of (scaler, kmeans), or None when the model was never retrained; the notebook pickle is no
+        fitted scaler, so there is nothing to fall back to and the percentile threshold is used instead.
+    """
+    if latest_version('popularity') is None:
+        logging.info("No retrained popularity model, using the view count percentile.")
+        return None
+    scaler = joblib.load(latest_artifact_path('popularity', 'scaler.pkl', None))
+    kmeans = joblib.load(latest_artifact_path('popularity', 'kmeans.pkl', None))
+    logging.info("Popularity model loaded successfully.")
+    return scaler, kmeans
+
+
+def classify_popularity(video_data, model=None):
+    """
+    Labels every video 'Popular' or 'Not Popular'. With a retrained model (see load_popularity_model), videos in
+    the cluster whose center has the highest scaled log views are popular; without one, videos at or above the
+    60th percentile of the view counts are.
+    """
+    if model is None:
+        popularity_threshold = np.percentile(video_data['view_count'], 60)
+        video_data['popularity'] = np.where(video_data['view_count'] >= popularity_threshold, 'Popular',
+                                            'Not Popular')
+        logging.info("Assigned popularity using the 60th percentile of view counts.")
+        return video_data
+
+    scaler, kmeans = model
+    # Same features, in the same order, as train_models.log_features
+    features = np.log1p(video_data[['view_count', 'like_count', 'comment_count']].fillna(0).to_numpy(dtype=float))
+    clusters = kmeans.predict(scaler.transform(features))
+    popular_cluster = int(np.argmax(kmeans.cluster_centers_[:, 0]))
+    video_data['popularity'] = np.where(clusters == popular_cluster, 'Popular', 'Not Popular')
+    logging.info("Assigned popularity using the retrained popularity clustering.")
+    return video_data
+
+
+def store_popularity(connection, cursor, video_data):
+    """
+    Writes the popularity ratings to 'dim_stats'. Only videos whose rating changed are written and audited.
+    :return: Number of written rows.
+    """
+    cursor.execute("""CREATE TABLE IF NOT EXISTS dim_stats (
+                        video_id TEXT PRIMARY KEY,
+                        popularity TEXT NOT NULL
+                      );""")
+    connection.commit()
+
+    cursor.execute("SELECT video_id, popularity FROM dim_stats;")
+    stored_popularity = dict(cursor.fetchall())
+
+    stats_data = video_data[['video_id', 'popularity']]
+    changed_data = stats_data[stats_data['video_id'].map(stored_popularity) != stats_data['popularity']]
+    for index, row in changed_data.iterrows():
+        old_popularity = stored_popularity.get(row['video_id'])
+        old_record = None if old_popularity is None else (row['video_id'], old_popularity)
+        insert_query = """
+            INSERT INTO dim_stats (video_id, popularity)
+            VALUES (%s, %s)
+            ON CONFLICT (video_id) DO UPDATE SET popularity = EXCLUDED.popularity;
+        """
+        cursor.execute(insert_query, (row['video_id'], row['popularity']))
+        log_audit_event(cursor, "system", "INSERT" if old_record is None else "UPDATE", "dim_stats",
+                        row['video_id'], old_record, row.to_dict())
+
+    connection.commit()
+    logging.info(f"Inserted popularity ratings for {len(changed_data)} of {len(stats_data)} videos into "
+                 f"'dim_stats' table.")
+    return len(changed_data)
+
+
+if __name__ == "__main__":
+    db_host = os.getenv('POSTGRES_HOST')
+    db_user = os.getenv('POSTGRES_USER')
+    db_password = os.getenv('POSTGRES_PASSWORD')
+    db_port = os.getenv('POSTGRES_PORT')
+    db_name = os.getenv('POSTGRES_DB')
+
+    try:
+        model = load_popularity_model()
+    except Exception as e:
+        logging.error(f"Error loading popularity model: {e}")
+        exit(1)
+
+    try:
+        with psycopg2.connect(
+                host=db_host,
+                port=db_port,
+                dbname=db_name,
+                user=db_user,
+                password=db_password,
+                sslmode='require'
+        ) as connection:
+            with connection.cursor() as cursor:
+                logging.info("Successfully connected to the database.")
+                create_audit_table(cursor)
+
+                video_data = fetch_video_metrics(connection)
+
+                if video_data.empty or 'view_count' not in video_data.columns:
+                    logging.error("The 'view_count' column is missing or data is empty.")
+                    exit(1)
+
+                video_data = classify_popularity(video_data, model)
+                store_popularity(connection, cursor, video_data)
+
+    except Exception as e:
+        logging.error(f"Unexpected error: {e}")
+    finally:
+        logging.info("Database connection closed.")
@@ -3,72 +3,43 @@ import joblib
 import psycopg2
 from dotenv import load_dotenv
 import os
-from audit import log_audit_event
+from audit import log_audit_event, create_audit_table
+from model_registry import latest_artifact_path
 
 # Load environment variables
 load_dotenv()
 
-# Step 1: Load Pre-trained Model and Vectorizer
-try:
-    classifier = joblib.load('models/sentiment_model.pkl')
-    vectorizer = joblib.load('models/tfidf_vectorizer.pkl')
-    print("Model and vectorizer loaded successfully!")
-except Exception as e:
-    print(f"Error loading model/vectorizer: {e}")
-    exit()
-
-# Step 2: Connect to PostgreSQL Database using psycopg2
-db_host = os.getenv('POSTGRES_HOST')
-db_user = os.getenv('POSTGRES_USER')
-db_password = os.getenv('POSTGRES_PASSWORD')
-db_port = os.getenv('POSTGRES_PORT')
-db_name = os.getenv('POSTGRES_DB')
-
-try:
-    connection = psycopg2.connect(
-        host=db_host,
-        port=db_port,
-        dbname=db_name,
-        user=db_user,
-        password=db_password,
-        sslmode='require'
-    )
-    cursor = connection.cursor()
-    print("Successfully connected to the database.")
-except psycopg2.Error as e:
-    print(f"Error connecting to the database: {e}")
-    exit()
-
-# Step 3: Fetch Video Data from the 'dim_transcripts' Table
-try:
-    video_data_query = "SELECT video_id, transcript FROM dim_transcripts;"
-    video_data = pd.read_sql(video_data_query, connection)
-    print(f"Fetched {len(video_data)} records from the database.")
-except Exception as e:
-    print(f"Error fetching data from the database: {e}")
-    exit()
-
-# Step 4: Pre-process and Vectorize the Data
-try:
-    print("Vectorizing transcript data...")
+
+def sentiment_vectorizer_path():
+    return latest_artifact_path('sentiment', 'vectorizer.pkl', 'models/tfidf_vectorizer.pkl')
+
+
+def load_sentiment_model():
+    # Prefer the latest model retrained by train_models.py over the notebook pickles
+    classifier = joblib.load(latest_artifact_path('sentiment', 'sentiment_model.pkl', 'models/sentiment_model.pkl'))
+    vectorizer = joblib.load(sentiment_vectorizer_path())
+    return classifier, vectorizer
+
+
+def fetch_transcripts(connection, video_ids=None):
+    """
+    Fetches transcripts from 'dim_transcripts', limited to 'video_ids' when given.
+    """
+    if video_ids is None:
+        video_data_query = "SELECT video_id, transcript FROM dim_transcripts;"
+        return pd.read_sql(video_data_query, connection)
+    video_data_query = "SELECT video_id, transcript FROM dim_transcripts WHERE video_id = ANY(%(video_ids)s);"
+    return pd.read_sql(video_data_query, connection, params={'video_ids': list(video_ids)})
+
+
+def predict_sentiment(video_data, classifier, vectorizer):
     X = vectorizer.transform(video_data['transcript'])
-    print("Transcript data successfully vectorized.")
-except Exception as e:
-    print(f"Error during vectorization: {e}")
-    exit()
-
-# Step 5: Predict Sentiment using the Pre-trained Model
-try:
-    print("Predicting sentiment labels...")
     predicted_labels = classifier.predict(X)
     video_data['sentiment'] = ['positive' if label == 1 else 'negative' for label in predicted_labels]
-    print("Sentiment labels predicted successfully.")
-except Exception as e:
-    print(f"Error during model prediction: {e}")
-    exit()
+    return video_data
+
 
-# Step 6: Create or Update Sentiment Data in 'dim_sentiment'
-try:
+def create_sentiment_table(connection, cursor):
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS dim_sentiment (
             video_id TEXT PRIMARY KEY,
@@ -76,16 +47,22 @@ try:
         );
     """)
     connection.commit()
-    print("Table 'dim_sentiment' has been created successfully.")
-except psycopg2.Error as e:
-    print(f"Error creating table 'dim_sentiment': {e}")
-    connection.close()
-    exit()
 
-try:
-    for _, row in video_data.iterrows():
-        cursor.execute("SELECT * FROM dim_sentiment WHERE video_id = %s;", (row['video_id'],))
-        old_record = cursor.fetchone()
+
+def store_sentiment(connection, cursor, video_data):
+    """
+    Writes the sentiment labels to 'dim_sentiment'. Only videos whose label changed are written and audited.
+    :return: Number of written rows.
+    """
+    cursor.execute("SELECT video_id, sentiment FROM dim_sentiment WHERE video_id = ANY(%s);",
+                   (video_data['video_id'].tolist(),))
+    stored_sentiment = dict(cursor.fetchall())
+
+    sentiment_data = video_data[['video_id', 'sentiment']]
+    changed_data = sentiment_data[sentiment_data['video_id'].map(stored_sentiment) != sentiment_data['sentiment']]
+    for _, row in changed_data.iterrows():
+        old_sentiment = stored_sentiment.get(row['video_id'])
+        old_record = None if old_sentiment is None else (row['video_id'], old_sentiment)
 
         cursor.execute("""
             INSERT INTO dim_sentiment (video_id, sentiment)
@@ -94,7 +71,7 @@ try:
         """, (row['video_id'], row['sentiment']))
 
         log_audit_event(
-            cursor, "system", 
+            cursor, "system",
             action="INSERT" if old_record is None else "UPDATE",
             table_name="dim_sentiment",
             record_id=row['video_id'],
@@ -103,10 +80,74 @@ try:
         )
 
     connection.commit()
-    print(f"Inserted sentiment results for {len(video_data)} records into 'dim_sentiment' table.")
-except psycopg2.Error as e:
-    print(f"Error inserting data into 'dim_sentiment' table: {e}")
-    connection.rollback()
-finally:
-    connection.close()
-    print("Database connection closed.")
+    return len(changed_data)
+
+
+if __name__ == "__main__":
+    # Step 1: Load Pre-trained Model and Vectorizer
+    try:
+        classifier, vectorizer = load_sentiment_model()
+        print("Model and vectorizer loaded successfully!")
+    except Exception as e:
+        print(f"Error loading model/vectorizer: {e}")
+        exit()
+
+    # Step 2: Connect to PostgreSQL Database using psycopg2
+    db_host = os.getenv('POSTGRES_HOST')
+    db_user = os.getenv('POSTGRES_USER')
+    db_password = os.getenv('POSTGRES_PASSWORD')
+    db_port = os.getenv('POSTGRES_PORT')
+    db_name = os.getenv('POSTGRES_DB')
+
+    try:
+        connection = psycopg2.connect(
+            host=db_host,
+            port=db_port,
+            dbname=db_name,
+            user=db_user,
+            password=db_password,
+            sslmode='require'
+        )
+        cursor = connection.cursor()
+        print("Successfully connected to the database.")
+        create_audit_table(cursor)
+    except psycopg2.Error as e:
+        print(f"Error connecting to the database: {e}")
+        exit()
+
+    # Step 3: Fetch Video Data from the 'dim_transcripts' Table
+    try:
+        video_data = fetch_transcripts(connection)
+        print(f"Fetched {len(video_data)} records from the database.")
+    except Exception as e:
+        print(f"Error fetching data from the database: {e}")
+        exit()
+
+    # Step 4 and 5: Vectorize the Data and Predict Sentiment using the Pre-trained Model
+    try:
+        print("Predicting sentiment labels...")
+        video_data = predict_sentiment(video_data, classifier, vectorizer)
+        print("Sentiment labels predicted successfully.")
+    except Exception as e:
+        print(f"Error during model prediction: {e}")
+        exit()
+
+    # Step 6: Create or Update Sentiment Data in 'dim_sentiment'
+    try:
+        create_sentiment_table(connection, cursor)
+        print("Table 'dim_sentiment' has been created successfully.")
+    except psycopg2.Error as e:
+        print(f"Error creating table 'dim_sentiment': {e}")
+        connection.close()
+        exit()
+
+    try:
+        written_rows = store_sentiment(connection, cursor, video_data)
+        print(f"Inserted sentiment results for {written_rows} of {len(video_data)} records into 'dim_sentiment' "
+              f"table.")
+    except psycopg2.Error as e:
+        print(f"Error inserting data into 'dim_sentiment' table: {e}")
+        connection.rollback()
+    finally:
+        connection.close()
+        print("Database connection closed.")
@@ -0,0 +1,316 @@
+import json
+import logging
+import os
+import shutil
+from datetime import datetime, timedelta
+
+import psycopg2
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from dotenv import load_dotenv
+
+from connection import connect_to_postgres, close_connection, stream_query
+
+# Load environment variables
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+EXPORT_DIR = os.getenv('EXPORT_DIR', 'exports')
+STATE_FILE = '_export_state.json'
+HIVE_NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+WATERMARK_OVERLAP = timedelta(minutes=int(os.getenv('EXPORT_WATERMARK_OVERLAP_MINUTES', '60')))
+
+PUBLISH_YEAR = "EXTRACT(YEAR FROM f.published_at)::int"
+
+# Every exported table is partitioned by the publish year of its video. For the history table the snapshot months
+# newer than the last exported snapshot are rewritten; for the other tables the publish years touched since the
+# last export (according to audit_logs) are rewritten. Both watermarks are moved back by WATERMARK_OVERLAP, so rows of
+# transactions that were still running during the previous export are picked up; rewriting keeps that idempotent.
+EXPORT_TABLES = {
+    'fact_video_metrics': {
+        'query': f"""
+            SELECT f.video_id, f.published_at, f.view_count, f.like_count, f.comment_count, f.duration,
+                   {PUBLISH_YEAR} AS publish_year
+            FROM fact_video_metrics f
+        """,
+        'schema': pa.schema([
+            ('video_id', pa.string()),
+            ('published_at', pa.timestamp('us')),
+            ('view_count', pa.int64()),
+            ('like_count', pa.int64()),
+            ('comment_count', pa.int64()),
+            ('duration', pa.string()),
+            ('publish_year', pa.int32()),
+        ]),
+        'partition_cols': ['publish_year'],
+    },
+    'fact_video_metrics_history': {
+        'query': f"""
+            SELECT h.video_id, h.snapshot_date, h.view_count, h.like_count, h.comment_count,
+                   {PUBLISH_YEAR} AS publish_year, to_char(h.snapshot_date, 'YYYY-MM') AS snapshot_month
+            FROM fact_video_metrics_history h
+            LEFT JOIN fact_video_metrics f ON f.video_id = h.video_id
+        """,
+        'schema': pa.schema([
+            ('video_id', pa.string()),
+            ('snapshot_date', pa.timestamp('us')),
+            ('view_count', pa.int64()),
+            ('like_count', pa.int64()),
+            ('comment_count', pa.int64()),
+            ('publish_year', pa.int32()),
+            ('snapshot_month', pa.string()),
+        ]),
+        'partition_cols': ['publish_year', 'snapshot_month'],
+        'watermark_column': 'snapshot_date',
+    },
+    'dim_video_info': {
+        'query': f"""
+            SELECT d.video_id, d.title, d.description, d.category, d.tags, {PUBLISH_YEAR} AS publish_year
+            FROM dim_video_info d
+            LEFT JOIN fact_video_metrics f ON f.video_id = d.video_id
+        """,
+        'schema': pa.schema([
+            ('video_id', pa.string()),
+            ('title', pa.string()),
+            ('description', pa.string()),
+            ('category', pa.string()),
+            ('tags', pa.list_(pa.string())),
+            ('publish_year', pa.int32()),
+        ]),
+        'partition_cols': ['publish_year'],
+    },
+    'dim_stats': {
+        'query': f"""
+            SELECT d.video_id, d.popularity, {PUBLISH_YEAR} AS publish_year
+            FROM dim_stats d
+            LEFT JOIN fact_video_metrics f ON f.video_id = d.video_id
+        """,
+        'schema': pa.schema([
+            ('video_id', pa.string()),
+            ('popularity', pa.string()),
+            ('publish_year', pa.int32()),
+        ]),
+        'partition_cols': ['publish_year'],
+    },
+    'dim_sentiment': {
+        'query': f"""
+            SELECT d.video_id, d.sentiment, {PUBLISH_YEAR} AS publish_year
+            FROM dim_sentiment d
+            LEFT JOIN fact_video_metrics f ON f.video_id = d.video_id
+        """,
+        'schema': pa.schema([
+            ('video_id', pa.string()),
+            ('sentiment', pa.string()),
+            ('publish_year', pa.int32()),
+        ]),
+        'partition_cols': ['publish_year'],
+    },
+}
+
+
+def load_export_state(export_dir=EXPORT_DIR):
+    """
+    Loads the export state (watermarks of the last successful export) from the export directory.
+    :return: Dictionary with the state, empty if nothing has been exported yet.
+    """
+    state_path = os.path.join(export_dir, STATE_FILE)
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path) as f:
+        return json.load(f)
+
+
+def save_export_state(state, export_dir=EXPORT_DIR):
+    os.makedirs(export_dir, exist_ok=True)
+    state_path = os.path.join(export_dir, STATE_FILE)
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, state_path)
+
+
+def rows_to_table(columns, rows, schema):
+    data = {column: list(values) for column, values in zip(columns, zip(*rows))}
+    return pa.Table.from_pydict(data, schema=schema)
+
+
+def touched_partitions(cursor, table_name, since):
+    """
+    Returns the publish years of the videos of 'table_name' that were inserted or updated after 'since',
+    based on the audit log.
+    """
+    cursor.execute(f"""
+        SELECT DISTINCT {PUBLISH_YEAR}
+        FROM audit_logs a
+        LEFT JOIN fact_video_metrics f ON f.video_id = a.record_id
+        WHERE a.table_name = %s AND a.action_time > %s;
+    """, (table_name, since))
+    return {row[0] for row in cursor.fetchall()}
+
+
+def touched_snapshot_months(cursor, since):
+    """
+    Returns the snapshot months of the history table that contain snapshots taken after 'since'.
+    """
+    cursor.execute("""
+        SELECT DISTINCT to_char(snapshot_date, 'YYYY-MM')
+        FROM fact_video_metrics_history
+        WHERE snapshot_date > %s;
+    """, (since,))
+    return {row[0] for row in cursor.fetchall()}
+
+
+def remove_snapshot_months(table_dir, months):
+    if not os.path.isdir(table_dir):
+        return
+    for year_dir in os.listdir(table_dir):
+        for month in months:
+            partition_dir = os.path.join(table_dir, year_dir, f"snapshot_month={month}")
+            if os.path.isdir(partition_dir):
+                shutil.rmtree(partition_dir)
+
+
+def remove_partitions(table_dir, years):
+    for year in years:
+        partition_dir = os.path.join(table_dir, f"publish_year={HIVE_NULL_PARTITION if year is None else year}")
+        if os.path.isdir(partition_dir):
+            shutil.rmtree(partition_dir)
+
+
+def write_chunks(conn, spec, table_dir, query, params, run_id):
+    """
+    :return: Tuple of (number of written rows, highest value of the watermark column of the table, if it has one).
+    """
+    written_rows = 0
+    watermark_column = spec.get('watermark_column')
+    watermark = None
+    for chunk_index, (columns, rows) in enumerate(stream_query(conn, query, params)):
+        table = rows_to_table(columns, rows, spec['schema'])
+        ds.write_dataset(
+            table,
+            table_dir,
+            format='parquet',
+            partitioning=spec['partition_cols'],
+            partitioning_flavor='hive',
+            basename_template=f"part-{run_id}-{chunk_index}-{{i}}.parquet",
+            existing_data_behavior='overwrite_or_ignore'
+        )
+        written_rows += table.num_rows
+        if watermark_column:
+            chunk_max = pc.max(table[watermark_column]).as_py()
+            if chunk_max is not None and (watermark is None or chunk_max > watermark):
+                watermark = chunk_max
+    return written_rows, watermark
+
+
+def export_table(conn, table_name, since, run_id, export_dir=EXPORT_DIR):
+    """
+    Exports one table to partitioned Parquet under 'export_dir/table_name'.
+    With 'since' set, only the partitions touched after that moment are rewritten; otherwise the full table is
+    exported. For the history table 'since' is a snapshot date, for the other tables an audit log time.
+    :return: Tuple of (number of rows written, highest exported value of the watermark column or None).
+    """
+    spec = EXPORT_TABLES[table_name]
+    table_dir = os.path.join(export_dir, table_name)
+    query = spec['query']
+    params = None
+
+    if since is None:
+        if os.path.isdir(table_dir):
+            shutil.rmtree(table_dir)
+    elif spec.get('watermark_column'):
+        with conn.cursor() as cursor:
+            months = touched_snapshot_months(cursor, since)
+        if not months:
+            logging.info(f"No snapshots of '{table_name}' taken after {since}.")
+            return 0, None
+        query += " WHERE to_char(h.snapshot_date, 'YYYY-MM') = ANY(%s)"
+        params = (sorted(months),)
+        remove_snapshot_months(table_dir, months)
+        logging.info(f"Rewriting {len(months)} snapshot months of '{table_name}'.")
+    else:
+        with conn.cursor() as cursor:
+            years = touched_partitions(cursor, table_name, since)
+        if not years:
+            logging.info(f"No partitions of '{table_name}' changed since {since}.")
+            return 0, None
+        query += f" WHERE {PUBLISH_YEAR} = ANY(%s) OR (%s AND f.published_at IS NULL)"
+        params = ([year for year in years if year is not None], None in years)
+        remove_partitions(table_dir, years)
+        logging.info(f"Rewriting {len(years)} publish year partitions of '{table_name}'.")
+
+    written_rows, watermark = write_chunks(conn, spec, table_dir, query, params, run_id)
+    logging.info(f"Exported {written_rows} rows of '{table_name}' to {table_dir}.")
+    return written_rows, watermark
+
+
+def parse_watermark(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+def export_star_schema(conn, export_dir=EXPORT_DIR, full=False):
+    """
+    Exports the star schema to partitioned Parquet, rewriting only the partitions touched since the last export.
+    The audit log watermark is the database time at the start of the export; the history watermark is the newest
+    exported snapshot date, since snapshot dates come from the clock of the ingest container, not the database.
+    :param full: Ignore the stored watermarks and export every table completely.
+    :return: Dictionary of table name to number of rows written.
+    """
+    state = {} if full else load_export_state(export_dir)
+
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT LOCALTIMESTAMP;")
+        export_started_at = cursor.fetchone()[0]
+
+    audit_watermark = parse_watermark(state.get('audit_watermark'))
+    history_watermark = parse_watermark(state.get('history_watermark'))
+    incremental = audit_watermark is not None
+    run_id = export_started_at.strftime('%Y%m%d%H%M%S')
+    exported = {}
+
+    for table_name, spec in EXPORT_TABLES.items():
+        if not incremental:
+            since = None
+        elif spec.get('watermark_column'):
+            since = history_watermark - WATERMARK_OVERLAP if history_watermark else datetime.min
+        else:
+            since = audit_watermark - WATERMARK_OVERLAP
+        try:
+            exported[table_name], watermark = export_table(conn, table_name, since, run_id, export_dir)
+        except psycopg2.Error as e:
+            logging.error(f"Error exporting table '{table_name}': {e}")
+            conn.rollback()
+            return exported
+        if spec.get('watermark_column') and watermark is not None:
+            history_watermark = max(history_watermark or watermark, watermark)
+
+    save_export_state({
+        'audit_watermark': export_started_at.isoformat(),
+        'history_watermark': history_watermark.isoformat() if history_watermark else None,
+        'tables': exported,
+    }, export_dir)
+    return exported
+
+
+def read_export(table_name, columns=None, predicate=None, export_dir=EXPORT_DIR):
+    """
+    Reads an exported table as a DataFrame. Only the requested columns are read, and 'predicate' is pushed down to
+    the partition directories and Parquet row groups, e.g. ds.field('publish_year') == 2017.
+    """
+    dataset = ds.dataset(os.path.join(export_dir, table_name), format='parquet', partitioning='hive')
+    return dataset.to_table(columns=columns, filter=predicate).to_pandas()
+
+
+if __name__ == "__main__":
+    conn = connect_to_postgres()
+    if not conn:
+        logging.error("Failed to connect to PostgreSQL.")
+        exit()
+
+    try:
+        exported = export_star_schema(conn, full=os.getenv('EXPORT_FULL', '').lower() == 'true')
+        logging.info(f"Export finished: {exported}")
+    finally:
+        close_connection(conn)
@@ -4,12 +4,14 @@ import pandas as pd
 import psycopg2
 import concurrent.futures
 from datetime import datetime
-from audit import log_audit_event
+from audit import create_audit_table
 from dotenv import load_dotenv
 from connection import connect_to_postgres, create_fact_table, create_dimension_tables, insert_video_metrics, \
-    insert_video_info, insert_transcripts, close_connection
+    insert_video_info, insert_transcripts, close_connection, create_transcript_failures_table, \
+    record_transcript_failures, clear_transcript_failures, create_history_table
+from trends import create_trends_table, refresh_trends
 from youtube_client import fetch_video_details
-from transcript import fetch_transcript_for_videos
+from transcript import fetch_transcripts
 
 # Load environment variables
 load_dotenv()
@@ -36,36 +38,54 @@ def insert_history_row(cursor, row, snapshot_date):
 
 
 def fetch_missing_transcripts(cursor, video_ids):
+    """
+    Returns the video IDs without a usable stored transcript, leaving out videos whose previous fetch failed and whose
+    retry moment in 'transcript_failures' has not been reached yet. Empty and 'NaN' transcripts written by earlier
+    versions count as missing, so they are fetched again and overwritten.
+    """
     cursor.execute(
-        "SELECT video_id FROM dim_transcripts WHERE video_id = ANY(%s)",
-        (video_ids,)
+        """
+        SELECT video_id FROM dim_transcripts
+        WHERE video_id = ANY(%s) AND transcript IS NOT NULL AND transcript NOT IN ('', 'NaN')
+        UNION ALL
+        SELECT video_id FROM transcript_failures WHERE video_id = ANY(%s) AND next_retry_at > NOW()
+        """,
+        (video_ids, video_ids)
     )
-    existing_transcripts = {row[0] for row in cursor.fetchall()}
-    missing_transcripts = [video_id for video_id in video_ids if video_id not in existing_transcripts]
+    skipped = {row[0] for row in cursor.fetchall()}
+    missing_transcripts = [video_id for video_id in video_ids if video_id not in skipped]
     return missing_transcripts
 
 
-def fetch_transcripts_concurrently(video_ids):
-    transcripts = {}
-    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-        logging.info(f"Fetching transcripts for {len(video_ids)} videos.")
-        future_to_video = {executor.submit(fetch_transcript_for_videos, [video_id]): video_id for video_id in video_ids}
-        for future in concurrent.futures.as_completed(future_to_video):
-            video_id = future_to_video[future]
-            try:
-                result = future.result()
-                transcript = result.get(video_id, None)
-                transcripts[video_id] = transcript if transcript is not None else ''
-                logging.info(f"Transcript fetched for video {video_id}.")
-            except Exception as e:
-                logging.error(f"Error fetching transcript for video {video_id}: {e}")
-    return transcripts
+def update_transcripts(cursor, video_ids):
+    """
+    Fetches the missing transcripts of the given videos and writes only the fetched rows. Failed fetches are
+    recorded in the negative cache so they are retried on an exponential schedule instead of on every run.
+    :return: Tuple of (DataFrame with the fetched transcripts, dictionary with the number of fetched transcripts,
+        skipped videos and failures per reason).
+    """
+    missing_transcript_ids = fetch_missing_transcripts(cursor, video_ids)
+    logging.info(f"Fetching transcripts for {len(missing_transcript_ids)} videos without existing transcripts.")
+    transcripts, failures = fetch_transcripts(missing_transcript_ids)
+
+    transcripts_df = pd.DataFrame(list(transcripts.items()), columns=['Video ID', 'Transcript'])
+    insert_transcripts(cursor, transcripts_df)
+    clear_transcript_failures(cursor, list(transcripts))
+    record_transcript_failures(cursor, failures)
+
+    counts = {'fetched': len(transcripts), 'skipped': len(video_ids) - len(missing_transcript_ids),
+              'disabled': 0, 'unavailable': 0, 'throttled': 0, 'error': 0}
+    for reason in failures.values():
+        counts[reason] += 1
+    logging.info(f"Transcript results: {counts}")
+    return transcripts_df, counts
 
 
 def save_video_metrics_to_history(cursor, video_data, weeks=1):
     snapshot_date = datetime.now()
     total_videos = len(video_data)
     inserted_videos = 0
+    snapshot_video_ids = []
 
     for _, row in video_data.iterrows():
         video_id = row['Video ID']
@@ -85,32 +105,45 @@ def save_video_metrics_to_history(cursor, video_data, weeks=1):
         ):
             insert_history_row(cursor, row, snapshot_date)
             inserted_videos += 1
+            snapshot_video_ids.append(video_id)
 
     logging.info(f"Inserted {inserted_videos} video metrics into history for the latest week.")
-
-
-if __name__ == "__main__":
-    if not os.path.exists(VIDEO_IDS_DIRECTORY):
-        logging.error(f"The directory {VIDEO_IDS_DIRECTORY} does not exist.")
-        exit()
-
-    tedx_video_ids = [filename.split('.')[0] for filename in os.listdir(VIDEO_IDS_DIRECTORY) if os.path.isfile(os.path.join(VIDEO_IDS_DIRECTORY, filename))]
-    logging.info(f"Extracted {len(tedx_video_ids)} TEDx video IDs.")
-
-    if not tedx_video_ids:
-        logging.error("No TEDx video IDs were found.")
-        exit()
-
-    conn = connect_to_postgres()
-    if not conn:
-        logging.error("Failed to connect to PostgreSQL.")
-        exit()
-
+    return snapshot_video_ids
+
+
+def list_video_ids(directory, since=None):
+    """
+    Lists the video IDs in the drop directory. Every file is named after the video ID it contains.
+    :param since: Only list files modified at or after this datetime.
+    """
+    with os.scandir(directory) as entries:
+        return [entry.name.split('.')[0] for entry in entries if entry.is_file() and
+                (since is None or entry.stat().st_mtime >= since.timestamp())]
+
+
+def ingest_videos(conn, tedx_video_ids, with_trends=True):
+    """
+    Fetches details, metrics and transcripts for the given video IDs and writes them to the star schema.
+    :param with_trends: Refresh 'dim_trends' for the videos that got a new history snapshot.
+    :return: Dictionary with the fetched video details ('videos'), the IDs of the videos with a new history
+        snapshot ('snapshot_video_ids'), the fetched transcripts ('transcripts') and the transcript counts
+        ('transcript_counts'). 'videos' is empty if nothing could be fetched.
+    """
+    result = {
+        'videos': pd.DataFrame(),
+        'snapshot_video_ids': [],
+        'transcripts': pd.DataFrame(columns=['Video ID', 'Transcript']),
+        'transcript_counts': {},
+    }
+    cursor = conn.cursor()
     try:
-        cursor = conn.cursor()
         logging.info("Creating fact and dimension tables if they don't exist.")
+        create_audit_table(cursor)
         create_fact_table(cursor)
         create_dimension_tables(cursor)
+        create_history_table(cursor)
+        create_transcript_failures_table(cursor)
+        create_trends_table(cursor)
         conn.commit()
 
         logging.info("Fetching video details for all videos.")
@@ -126,7 +159,7 @@ if __name__ == "__main__":
         video_details_df = pd.DataFrame(video_details)
         if video_details_df.empty:
             logging.error("No video details were fetched.")
-            exit()
+            return result
 
         video_details_df.fillna({
             'Transcript': '',
@@ -142,29 +175,48 @@ if __name__ == "__main__":
         conn.commit()
 
         logging.info("Processing videos for potential metric updates.")
-        save_video_metrics_to_history(cursor, video_details_df, weeks=1)
+        snapshot_video_ids = save_video_metrics_to_history(cursor, video_details_df, weeks=1)
         conn.commit()
 
-        missing_transcript_ids = fetch_missing_transcripts(cursor, tedx_video_ids)
-        logging.info(f"Fetching transcripts for {len(missing_transcript_ids)} videos without existing transcripts.")
-        transcripts = fetch_transcripts_concurrently(missing_transcript_ids)
-        video_details_df['Transcript'] = video_details_df['Video ID'].map(transcripts)
+        if with_trends:
+            refresh_trends(cursor, snapshot_video_ids)
 
         logging.info("Inserting video metrics and info.")
         insert_video_metrics(cursor, video_details_df)
-        insert_transcripts(cursor, video_details_df[['Video ID', 'Transcript']])
         conn.commit()
 
-        for video_id in tedx_video_ids:
-            log_audit_event(cursor, "system", "INSERT", "fact_video_metrics", video_id)
-
+        transcripts_df, transcript_counts = update_transcripts(cursor, video_details_df['Video ID'].tolist())
         conn.commit()
         logging.info("New videos and historical metrics have been successfully inserted into the database.")
 
+        result.update(videos=video_details_df, snapshot_video_ids=snapshot_video_ids, transcripts=transcripts_df,
+                      transcript_counts=transcript_counts)
+        return result
+    finally:
+        cursor.close()
+
+
+if __name__ == "__main__":
+    if not os.path.exists(VIDEO_IDS_DIRECTORY):
+        logging.error(f"The directory {VIDEO_IDS_DIRECTORY} does not exist.")
+        exit()
+
+    tedx_video_ids = list_video_ids(VIDEO_IDS_DIRECTORY)
+    logging.info(f"Extracted {len(tedx_video_ids)} TEDx video IDs.")
+
+    if not tedx_video_ids:
+        logging.error("No TEDx video IDs were found.")
+        exit()
+
+    conn = connect_to_postgres()
+    if not conn:
+        logging.error("Failed to connect to PostgreSQL.")
+        exit()
+
+    try:
+        ingest_videos(conn, tedx_video_ids)
     except psycopg2.Error as e:
         logging.error(f"Database error: {e}")
         conn.rollback()
     finally:
-        if conn:
-            cursor.close()
-            close_connection(conn)
+        close_connection(conn)
@@ -0,0 +1,54 @@
+import json
+import logging
+import os
+from datetime import datetime
+
+import joblib
+
+MODEL_DIR = os.getenv('MODEL_DIR', 'models')
+LATEST_FILE = 'LATEST'
+
+
+def latest_version(model_name, model_dir=MODEL_DIR):
+    """
+    Returns the version of a model that the deploy scripts should use, or None if it was never retrained.
+    """
+    latest_path = os.path.join(model_dir, model_name, LATEST_FILE)
+    if not os.path.exists(latest_path):
+        return None
+    with open(latest_path) as f:
+        return f.read().strip() or None
+
+
+def latest_artifact_path(model_name, filename, default_path, model_dir=MODEL_DIR):
+    """
+    Returns the path of an artifact of the latest retrained version of a model, falling back to 'default_path'
+    (the pickles produced by the notebooks) when no retrained version exists.
+    """
+    version = latest_version(model_name, model_dir)
+    if version is None:
+        return default_path
+    return os.path.join(model_dir, model_name, version, filename)
+
+
+def save_artifacts(model_name, artifacts, metadata=None, model_dir=MODEL_DIR):
+    """
+    Writes a new version of a model and then points LATEST at it, so readers never see a half-written version.
+    :param artifacts: Dictionary of file name to object to pickle.
+    :return: The new version.
+    """
+    version = datetime.now().strftime('v%Y%m%d%H%M%S')
+    version_dir = os.path.join(model_dir, model_name, version)
+    os.makedirs(version_dir, exist_ok=True)
+
+    for filename, artifact in artifacts.items():
+        joblib.dump(artifact, os.path.join(version_dir, filename))
+    with open(os.path.join(version_dir, 'metadata.json'), 'w') as f:
+        json.dump({'version': version, 'created_at': datetime.now().isoformat(), **(metadata or {})}, f, indent=2)
+
+    latest_path = os.path.join(model_dir, model_name, LATEST_FILE)
+    with open(latest_path + '.tmp', 'w') as f:
+        f.write(version)
+    os.replace(latest_path + '.tmp', latest_path)
+    logging.info(f"Saved {model_name} model version {version} to {version_dir}.")
+    return version
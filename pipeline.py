@@ -0,0 +1,325 @@
+import argparse
+import concurrent.futures
+import logging
+import os
+from datetime import datetime, timedelta
+
+from dotenv import load_dotenv
+
+from audit import create_audit_table, migrate_legacy_audit_table, drop_expired_audit_partitions
+from connection import connect_to_postgres, close_connection
+from deploy_popularity_classification import load_popularity_model, fetch_video_metrics, classify_popularity, \
+    store_popularity
+from deploy_sentiment_score import load_sentiment_model, fetch_transcripts, predict_sentiment, \
+    create_sentiment_table, store_sentiment
+from export_parquet import export_star_schema
+from main import VIDEO_IDS_DIRECTORY, ingest_videos, list_video_ids
+from similar_talks import create_similar_table, update_similar_talks, load_similar_vectorizer
+from trends import create_trends_table, refresh_trends, fetch_videos_with_new_snapshots
+
+# Load environment variables
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+MAX_WORKERS = int(os.getenv('PIPELINE_WORKERS', '4'))
+# Same as the standalone deploy scripts; set POSTGRES_SSLMODE=disable for a local database without TLS
+SSLMODE = os.getenv('POSTGRES_SSLMODE', 'require')
+# With --since-last-run, changes are picked up from this long before the previous run started, so rows committed by
+# transactions that were still running at that moment are not missed
+RUN_WATERMARK_OVERLAP = timedelta(minutes=int(os.getenv('PIPELINE_WATERMARK_OVERLAP_MINUTES', '60')))
+
+
+def run_models(conn, context):
+    """
+    Loads all models once, in parallel with the ingestion, so the later stages share them.
+    """
+    classifier, vectorizer = load_sentiment_model()
+    return {'popularity': load_popularity_model(), 'classifier': classifier, 'vectorizer': vectorizer,
+            'similar_vectorizer': load_similar_vectorizer()}
+
+
+def run_ingest(conn, context):
+    if not os.path.exists(VIDEO_IDS_DIRECTORY):
+        logging.warning(f"The directory {VIDEO_IDS_DIRECTORY} does not exist, nothing to ingest.")
+        return None
+
+    tedx_video_ids = list_video_ids(VIDEO_IDS_DIRECTORY, since=context['since'])
+    logging.info(f"Extracted {len(tedx_video_ids)} TEDx video IDs.")
+    if not tedx_video_ids:
+        return None
+    return ingest_videos(conn, tedx_video_ids, with_trends=False)
+
+
+def changed_ids_since(conn, query, since):
+    with conn.cursor() as cursor:
+        cursor.execute(query, (since,))
+        return [row[0] for row in cursor.fetchall()]
+
+
+def run_popularity(conn, context):
+    # The clusters and the percentile fallback are relative to all videos, so all metrics are read; only changed
+    # ratings are written.
+    models = context['results']['models']
+    video_data = fetch_video_metrics(conn)
+    if video_data.empty:
+        logging.warning("No video metrics to classify.")
+        return 0
+    video_data = classify_popularity(video_data, models['popularity'])
+    with conn.cursor() as cursor:
+        return store_popularity(conn, cursor, video_data)
+
+
+def run_sentiment(conn, context):
+    models = context['results']['models']
+    results = context['results']
+
+    if 'ingest' in results:
+        ingested = results['ingest']
+        if ingested is None or ingested['transcripts'].empty:
+            logging.info("No new transcripts, sentiment is up to date.")
+            return 0
+        video_data = ingested['transcripts'].rename(columns={'Video ID': 'video_id', 'Transcript': 'transcript'})
+    elif context['audit_since']:
+        video_ids = changed_ids_since(conn, """
+            SELECT DISTINCT record_id FROM audit_logs
+            WHERE table_name = 'dim_transcripts' AND action_time >= %s;
+        """, context['audit_since'])
+        video_data = fetch_transcripts(conn, video_ids)
+    else:
+        video_data = fetch_transcripts(conn)
+
+    if video_data.empty:
+        logging.info("No transcripts to score.")
+        return 0
+
+    video_data = predict_sentiment(video_data, models['classifier'], models['vectorizer'])
+    with conn.cursor() as cursor:
+        create_sentiment_table(conn, cursor)
+        written_rows = store_sentiment(conn, cursor, video_data)
+    logging.info(f"Inserted sentiment results for {written_rows} of {len(video_data)} records into 'dim_sentiment' "
+                 f"table.")
+    return written_rows
+
+
+def run_trends(conn, context):
+    results = context['results']
+    with conn.cursor() as cursor:
+        create_trends_table(cursor)
+        if 'ingest' in results:
+            video_ids = results['ingest']['snapshot_video_ids'] if results['ingest'] else []
+        elif context['since']:
+            video_ids = changed_ids_since(conn, """
+                SELECT DISTINCT video_id FROM fact_video_metrics_history WHERE snapshot_date >= %s;
+            """, context['since'])
+        else:
+            video_ids = fetch_videos_with_new_snapshots(cursor)
+        return refresh_trends(cursor, video_ids)
+
+
+def run_similar(conn, context):
+    results = context['results']
+    if 'ingest' in results and (results['ingest'] is None or results['ingest']['transcripts'].empty):
+        logging.info("No new transcripts, similar talks are up to date.")
+        return None
+    with conn.cursor() as cursor:
+        create_similar_table(cursor)
+    update_similar_talks(conn, results['models']['similar_vectorizer'])
+    return None
+
+
+def run_export(conn, context):
+    return export_star_schema(conn)
+
+
+def run_audit(conn, context):
+    # Maintenance on its own connection, so the other stages never wait for a legacy migration or retention
+    with conn.cursor() as cursor:
+        migrated_rows = migrate_legacy_audit_table(cursor)
+        dropped_partitions = drop_expired_audit_partitions(cursor)
+    return {'migrated_rows': migrated_rows, 'dropped_partitions': dropped_partitions}
+
+
+# Stages with the stages they depend on. A dependency that is not selected for a run is assumed to be satisfied
+# by the data already in the database; 'models' is always added when a stage needs it.
+STAGES = {
+    'models': {'run': run_models, 'depends_on': [], 'needs_db': False},
+    'ingest': {'run': run_ingest, 'depends_on': [], 'needs_db': True},
+    'popularity': {'run': run_popularity, 'depends_on': ['models', 'ingest'], 'needs_db': True},
+    'sentiment': {'run': run_sentiment, 'depends_on': ['models', 'ingest'], 'needs_db': True},
+    'trends': {'run': run_trends, 'depends_on': ['ingest'], 'needs_db': True},
+    'similar': {'run': run_similar, 'depends_on': ['models', 'ingest'], 'needs_db': True},
+    'export': {'run': run_export, 'depends_on': ['ingest', 'popularity', 'sentiment', 'trends'], 'needs_db': True},
+    'audit': {'run': run_audit, 'depends_on': [], 'needs_db': True},
+}
+
+
+def resolve_stages(only=None):
+    selected = set(only) if only else set(STAGES)
+    if any('models' in STAGES[name]['depends_on'] for name in selected):
+        selected.add('models')
+    return selected
+
+
+def run_stage(name, context):
+    stage = STAGES[name]
+    logging.info(f"Starting stage '{name}'.")
+    if not stage['needs_db']:
+        return stage['run'](None, context)
+
+    # Every stage gets its own connection, so concurrent stages do not share a transaction
+    conn = connect_to_postgres(sslmode=SSLMODE)
+    if not conn:
+        raise RuntimeError(f"Failed to connect to PostgreSQL for stage '{name}'.")
+    try:
+        return stage['run'](conn, context)
+    finally:
+        close_connection(conn)
+
+
+def prepare_audit_table():
+    """
+    Creates or migrates 'audit_logs' and its partition for the current month once, before concurrent stages start
+    writing audit events.
+    """
+    conn = connect_to_postgres(sslmode=SSLMODE)
+    if not conn:
+        raise RuntimeError("Failed to connect to PostgreSQL to prepare 'audit_logs'.")
+    try:
+        with conn.cursor() as cursor:
+            create_audit_table(cursor)
+    finally:
+        close_connection(conn)
+
+
+def create_pipeline_runs_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS pipeline_runs (
+            run_name TEXT PRIMARY KEY,
+            db_started_at TIMESTAMP NOT NULL,
+            local_started_at TIMESTAMP NOT NULL
+        );
+    """)
+    cursor.connection.commit()
+
+
+def start_run_watermark(run_name):
+    """
+    Reads the start of the last successful run with the same stages and the start of this run. Both are kept on
+    the database clock, for comparisons with 'audit_logs', and on the local clock, for comparisons with file
+    mtimes and history snapshot dates, which are written with this process' clock.
+    :return: Tuple of (since, audit_since, started) where 'since' and 'audit_since' are None if there was no
+        successful run yet, and 'started' is the (database, local) start of this run to pass to save_run_watermark.
+    """
+    conn = connect_to_postgres(sslmode=SSLMODE)
+    if not conn:
+        raise RuntimeError("Failed to connect to PostgreSQL to read the pipeline watermark.")
+    try:
+        with conn.cursor() as cursor:
+            create_pipeline_runs_table(cursor)
+            cursor.execute("SELECT LOCALTIMESTAMP;")
+            started = (cursor.fetchone()[0], datetime.now())
+            cursor.execute("SELECT db_started_at, local_started_at FROM pipeline_runs WHERE run_name = %s;",
+                           (run_name,))
+            previous = cursor.fetchone()
+    finally:
+        close_connection(conn)
+
+    if previous is None:
+        logging.info(f"No previous successful run of '{run_name}', processing everything.")
+        return None, None, started
+    logging.info(f"Processing what changed since the run of '{run_name}' started at {previous[1]}.")
+    return previous[1] - RUN_WATERMARK_OVERLAP, previous[0] - RUN_WATERMARK_OVERLAP, started
+
+
+def save_run_watermark(run_name, started):
+    conn = connect_to_postgres(sslmode=SSLMODE)
+    if not conn:
+        raise RuntimeError("Failed to connect to PostgreSQL to save the pipeline watermark.")
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO pipeline_runs (run_name, db_started_at, local_started_at) VALUES (%s, %s, %s)
+                ON CONFLICT (run_name) DO UPDATE
+                SET db_started_at = EXCLUDED.db_started_at, local_started_at = EXCLUDED.local_started_at;
+            """, (run_name, *started))
+        conn.commit()
+    finally:
+        close_connection(conn)
+
+
+def run_pipeline(only=None, since=None, max_workers=MAX_WORKERS, since_last_run=False):
+    """
+    Runs the selected stages as a dependency graph in one process. Stages whose dependencies are done run
+    concurrently, and their results (ingested frames, changed IDs, loaded models) are handed to the next stages
+    in memory instead of being re-read from the database.
+    :param only: Names of the stages to run, all stages if empty.
+    :param since: Only process what changed since this datetime when the ingest stage is not part of the run.
+    :param since_last_run: Take 'since' from the start of the last successful run with the same stages, and record
+        this run's start when it succeeds, so scheduled runs only process what changed in between.
+    :return: Set of the names of stages that failed or were skipped because a dependency failed.
+    """
+    selected = resolve_stages(only)
+    run_name = ','.join(sorted(selected))
+    audit_since, started = since, None
+    if since_last_run:
+        since, audit_since, started = start_run_watermark(run_name)
+    context = {'since': since, 'audit_since': audit_since, 'results': {}}
+    if any(STAGES[name]['needs_db'] for name in selected):
+        prepare_audit_table()
+    pending = [name for name in STAGES if name in selected]
+    failed = set()
+    running = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for name in list(pending):
+                dependencies = [dependency for dependency in STAGES[name]['depends_on'] if dependency in selected]
+                if any(dependency in failed for dependency in dependencies):
+                    logging.error(f"Skipping stage '{name}' because a dependency failed.")
+                    pending.remove(name)
+                    failed.add(name)
+                elif all(dependency in context['results'] for dependency in dependencies):
+                    pending.remove(name)
+                    running[executor.submit(run_stage, name, context)] = name
+
+            if not running:
+                continue
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    context['results'][name] = future.result()
+                    logging.info(f"Stage '{name}' finished.")
+                except Exception as e:
+                    logging.error(f"Stage '{name}' failed: {e}")
+                    failed.add(name)
+
+    if started and not failed:
+        save_run_watermark(run_name, started)
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run ingest, popularity, sentiment and derived jobs in one process.")
+    parser.add_argument('--only', type=lambda value: [name.strip() for name in value.split(',') if name.strip()],
+                        help=f"Comma-separated stages to run: {', '.join(STAGES)}.")
+    parser.add_argument('--since', type=datetime.fromisoformat,
+                        help="Only process what changed since this date or datetime (ISO format).")
+    parser.add_argument('--since-last-run', action='store_true',
+                        help="Only process what changed since the last successful run of the same stages.")
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS, help="Maximum number of concurrent stages.")
+    args = parser.parse_args()
+
+    unknown_stages = set(args.only or []) - set(STAGES)
+    if unknown_stages:
+        parser.error(f"Unknown stages: {', '.join(sorted(unknown_stages))}")
+
+    if args.since and args.since_last_run:
+        parser.error("--since and --since-last-run cannot be combined.")
+
+    failed_stages = run_pipeline(args.only, args.since, args.workers, args.since_last_run)
+    if failed_stages:
+        logging.error(f"Pipeline finished with failed stages: {', '.join(sorted(failed_stages))}")
+        exit(1)
+    logging.info("Pipeline finished successfully.")
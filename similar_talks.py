@@ -0,0 +1,281 @@
+import json
+import logging
+import os
+
+import joblib
+import numpy as np
+import psycopg2
+import psycopg2.extras
+import scipy.sparse as sp
+from dotenv import load_dotenv
+from joblib import Parallel, delayed
+from sklearn.preprocessing import normalize
+
+from connection import connect_to_postgres, close_connection, stream_query
+from model_registry import latest_artifact_path
+
+# Load environment variables
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+CACHE_DIR = os.getenv('SIMILAR_CACHE_DIR', 'state')
+TOP_K = int(os.getenv('SIMILAR_TOP_K', '10'))
+# Peak memory of the scoring is N_JOBS times WORKER_MEMORY_BYTES, so all cores are only used up to a point
+N_JOBS = int(os.getenv('SIMILAR_N_JOBS', str(min(os.cpu_count() or 1, 8))))
+# Memory one worker may use for a block of similarity scores. Every cell of a block costs about 24 bytes at peak:
+# the sparse product (float32 value and int32 index), the dense float32 scores, the int64 argpartition result and
+# the boolean mask of reverse candidates.
+WORKER_MEMORY_BYTES = int(os.getenv('SIMILAR_WORKER_MEMORY_MB', '256')) * 1024 * 1024
+BYTES_PER_CELL = 24
+BLOCK_CELLS = WORKER_MEMORY_BYTES // BYTES_PER_CELL
+
+
+def similar_vectorizer_path():
+    # The TF-IDF vectorizer of the sentiment notebook. The retrained sentiment model hashes its features without
+    # IDF weighting, which would let common words dominate the similarity scores, so it is deliberately not used.
+    return latest_artifact_path('similar', 'tfidf_vectorizer.pkl', 'models/tfidf_vectorizer.pkl')
+
+
+def load_similar_vectorizer():
+    return joblib.load(similar_vectorizer_path())
+
+
+def create_similar_table(cursor):
+    """
+    Creates the table 'dim_similar' with the top-k most similar talks of every video.
+    """
+    try:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS dim_similar (
+                video_id TEXT NOT NULL,
+                neighbor_id TEXT NOT NULL,
+                score REAL NOT NULL,
+                PRIMARY KEY (video_id, neighbor_id)
+            );
+        """)
+        cursor.connection.commit()
+        logging.info("Table 'dim_similar' created or already exists.")
+    except psycopg2.Error as e:
+        logging.error(f"Error creating table 'dim_similar': {e}")
+        cursor.connection.rollback()
+
+
+def vectorize_transcripts(conn, vectorizer, exclude_ids=None):
+    """
+    Streams the non-empty transcripts from 'dim_transcripts' and turns them into L2-normalized TF-IDF vectors.
+    :return: Tuple of (list of video IDs, CSR matrix with one row per video).
+    """
+    video_ids, blocks = [], []
+    query = """
+        SELECT video_id, transcript FROM dim_transcripts
+        WHERE transcript <> '' AND NOT (video_id = ANY(%s))
+        ORDER BY video_id
+    """
+    for _, rows in stream_query(conn, query, (list(exclude_ids or []),)):
+        video_ids.extend(row[0] for row in rows)
+        blocks.append(vectorizer.transform([row[1] for row in rows]))
+
+    if not blocks:
+        return [], sp.csr_matrix((0, vectorizer.transform(['']).shape[1]), dtype=np.float32)
+    matrix = normalize(sp.vstack(blocks).tocsr().astype(np.float32), norm='l2', copy=False)
+    logging.info(f"Vectorized {len(video_ids)} transcripts.")
+    return video_ids, matrix
+
+
+def load_vector_cache():
+    """
+    Loads the cached transcript vectors, unless they were built with another version of the vectorizer.
+    :return: Tuple of (list of video IDs, CSR matrix), or None if there is no usable cache.
+    """
+    meta_path = os.path.join(CACHE_DIR, 'similar_vectors.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta.get('vectorizer_path') != similar_vectorizer_path() or \
+            meta.get('vectorizer_mtime') != os.path.getmtime(similar_vectorizer_path()):
+        logging.info("Vectorizer changed since the vectors were cached, rebuilding the similarity index.")
+        return None
+    matrix = sp.load_npz(os.path.join(CACHE_DIR, 'similar_vectors.npz')).tocsr()
+    return meta['video_ids'], matrix
+
+
+def save_vector_cache(video_ids, matrix):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    sp.save_npz(os.path.join(CACHE_DIR, 'similar_vectors.npz'), matrix)
+    with open(os.path.join(CACHE_DIR, 'similar_vectors.json'), 'w') as f:
+        json.dump({'vectorizer_path': similar_vectorizer_path(),
+                   'vectorizer_mtime': os.path.getmtime(similar_vectorizer_path()), 'video_ids': video_ids}, f)
+
+
+def top_k_block(block, matrix_t, start, k, kth_scores=None):
+    """
+    Scores one block of rows against all vectors and keeps the top-k neighbours of every row.
+    :param block: Rows start..start+len(block) of the normalized matrix.
+    :param matrix_t: Transpose of the full normalized matrix.
+    :param kth_scores: Optional lowest stored neighbour score per column; pairs beating it are returned as well,
+        so existing neighbour lists can take in the rows of this block.
+    :return: Tuple of (forward pairs, reverse pairs), each as (row indices, column indices, scores) arrays.
+    """
+    scores = (block @ matrix_t).toarray()
+    rows = np.arange(block.shape[0])
+    scores[rows, start + rows] = -1.0
+
+    k = min(k, scores.shape[1] - 1)
+    if k <= 0:
+        empty = (np.array([], dtype=np.int64),) * 2 + (np.array([], dtype=np.float32),)
+        return empty, empty
+
+    # Partition on the scores themselves instead of their negation, which would be another copy of the block
+    top = np.argpartition(scores, -k, axis=1)[:, -k:]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    keep = top_scores > 0
+    forward = (np.repeat(start + rows, k).reshape(-1, k)[keep], top[keep], top_scores[keep])
+
+    reverse = (np.array([], dtype=np.int64),) * 2 + (np.array([], dtype=np.float32),)
+    if kth_scores is not None:
+        block_rows, columns = np.nonzero(scores > kth_scores)
+        reverse = (columns, start + block_rows, scores[block_rows, columns])
+    return forward, reverse
+
+
+def compute_neighbours(matrix, start, k=TOP_K, kth_scores=None):
+    """
+    Computes the top-k neighbours of rows start..end of 'matrix' against all rows, in blocks spread over all cores.
+    :return: Tuple of (forward pairs, reverse pairs) like top_k_block, concatenated over all blocks.
+    """
+    total_rows = matrix.shape[0]
+    block_size = max(1, BLOCK_CELLS // max(total_rows, 1))
+    matrix_t = matrix.T.tocsr()
+
+    results = Parallel(n_jobs=N_JOBS)(
+        delayed(top_k_block)(matrix[block_start:block_start + block_size], matrix_t, block_start, k, kth_scores)
+        for block_start in range(start, total_rows, block_size)
+    )
+
+    def concat(pairs):
+        return tuple(np.concatenate(parts) for parts in zip(*pairs)) if pairs else ((),) * 3
+
+    return concat([forward for forward, _ in results]), concat([reverse for _, reverse in results])
+
+
+def pairs_to_rows(video_ids, pairs):
+    row_indices, column_indices, scores = pairs
+    return [(video_ids[row], video_ids[column], float(score))
+            for row, column, score in zip(row_indices, column_indices, scores)]
+
+
+def write_neighbours(cursor, rows, replace_ids=None):
+    """
+    Upserts neighbour rows. The neighbour lists of 'replace_ids' are cleared first.
+    """
+    if replace_ids:
+        cursor.execute("DELETE FROM dim_similar WHERE video_id = ANY(%s);", (list(replace_ids),))
+    psycopg2.extras.execute_values(cursor, """
+        INSERT INTO dim_similar (video_id, neighbor_id, score) VALUES %s
+        ON CONFLICT (video_id, neighbor_id) DO UPDATE SET score = EXCLUDED.score;
+    """, rows, page_size=10000)
+
+
+def prune_neighbours(cursor, video_ids, k=TOP_K):
+    """
+    Trims the neighbour lists of the given videos back to their k best neighbours.
+    """
+    cursor.execute("""
+        DELETE FROM dim_similar d
+        USING (
+            SELECT video_id, neighbor_id,
+                   ROW_NUMBER() OVER (PARTITION BY video_id ORDER BY score DESC) AS rank
+            FROM dim_similar
+            WHERE video_id = ANY(%s)
+        ) ranked
+        WHERE d.video_id = ranked.video_id AND d.neighbor_id = ranked.neighbor_id AND ranked.rank > %s;
+    """, (list(video_ids), k))
+
+
+def fetch_kth_scores(cursor, video_ids, k=TOP_K):
+    """
+    Returns for every video the score a new neighbour has to beat to enter its top-k list.
+    """
+    cursor.execute("SELECT video_id, MIN(score), COUNT(*) FROM dim_similar GROUP BY video_id;")
+    stored = {row[0]: (row[1] if row[2] >= k else 0.0) for row in cursor.fetchall()}
+    return np.array([stored.get(video_id, 0.0) for video_id in video_ids], dtype=np.float32)
+
+
+def rebuild_similar_talks(conn, vectorizer, k=TOP_K):
+    """
+    Rebuilds the complete similarity index from all transcripts.
+    """
+    video_ids, matrix = vectorize_transcripts(conn, vectorizer)
+    forward, _ = compute_neighbours(matrix, 0, k)
+
+    with conn.cursor() as cursor:
+        cursor.execute("TRUNCATE dim_similar;")
+        write_neighbours(cursor, pairs_to_rows(video_ids, forward))
+    conn.commit()
+    save_vector_cache(video_ids, matrix)
+    logging.info(f"Rebuilt similar talks for {len(video_ids)} videos ({len(forward[0])} pairs).")
+
+
+def update_similar_talks(conn, vectorizer, k=TOP_K):
+    """
+    Adds the transcripts that are not in the index yet. Only their neighbour lists are computed, and existing lists
+    are updated only where a new talk beats their current k-th neighbour. Falls back to a full rebuild when there
+    is no usable vector cache.
+    """
+    cache = load_vector_cache()
+    if cache is None:
+        rebuild_similar_talks(conn, vectorizer, k)
+        return
+
+    old_ids, old_matrix = cache
+    new_ids, new_matrix = vectorize_transcripts(conn, vectorizer, exclude_ids=set(old_ids))
+    if not new_ids:
+        logging.info("No new transcripts, similar talks are up to date.")
+        return
+
+    video_ids = old_ids + new_ids
+    matrix = sp.vstack([old_matrix, new_matrix]).tocsr()
+
+    with conn.cursor() as cursor:
+        kth_scores = fetch_kth_scores(cursor, video_ids, k)
+        # New videos get their lists from the forward pass, so they are never reverse candidates
+        kth_scores[len(old_ids):] = np.inf
+        forward, reverse = compute_neighbours(matrix, len(old_ids), k, kth_scores)
+
+        write_neighbours(cursor, pairs_to_rows(video_ids, forward), replace_ids=new_ids)
+        reverse_rows = pairs_to_rows(video_ids, reverse)
+        if reverse_rows:
+            write_neighbours(cursor, reverse_rows)
+            prune_neighbours(cursor, {row[0] for row in reverse_rows}, k)
+    conn.commit()
+    save_vector_cache(video_ids, matrix)
+    logging.info(f"Added {len(new_ids)} videos to similar talks, updated {len(reverse_rows)} existing neighbours.")
+
+
+if __name__ == "__main__":
+    try:
+        vectorizer = load_similar_vectorizer()
+        logging.info("Vectorizer loaded successfully.")
+    except Exception as e:
+        logging.error(f"Error loading vectorizer: {e}")
+        exit(1)
+
+    conn = connect_to_postgres()
+    if not conn:
+        logging.error("Failed to connect to PostgreSQL.")
+        exit(1)
+
+    try:
+        with conn.cursor() as cursor:
+            create_similar_table(cursor)
+        if os.getenv('SIMILAR_REBUILD', '').lower() == 'true':
+            rebuild_similar_talks(conn, vectorizer)
+        else:
+            update_similar_talks(conn, vectorizer)
+    except psycopg2.Error as e:
+        logging.error(f"Database error: {e}")
+        conn.rollback()
+    finally:
+        close_connection(conn)
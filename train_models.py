@@ -0,0 +1,233 @@
+import argparse
+import logging
+import os
+import zlib
+
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.naive_bayes import MultinomialNB
+from sklearn.preprocessing import StandardScaler
+
+from connection import connect_to_postgres, close_connection, stream_query
+from model_registry import save_artifacts
+
+# Load environment variables
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+CHUNK_SIZE = 20000
+HASHING_FEATURES = 2 ** 20
+# Passes over the metrics for the popularity clustering, stopped early once no cluster center moves more than
+# KMEANS_TOLERANCE (in scaled feature units) during a pass
+KMEANS_MAX_EPOCHS = 20
+KMEANS_TOLERANCE = 1e-4
+KMEANS_BATCH_SIZE = 4096
+# Labelled transcripts without a video ID, in the format of the sentiment notebook: ';'-delimited with a
+# transcript and a label column
+SENTIMENT_LABELS_CSV = os.getenv('SENTIMENT_LABELS_CSV')
+# Every video whose ID hashes into this bucket (out of 10) is held out to evaluate the sentiment model
+HOLDOUT_BUCKET = 0
+
+
+def log_features(rows):
+    """
+    Same features as the popularity notebook: log1p of views, likes and comments.
+    """
+    metrics = np.array([[row[0] or 0, row[1] or 0, row[2] or 0] for row in rows], dtype=np.float64)
+    return np.log1p(metrics)
+
+
+def train_popularity_model(conn, chunk_size=CHUNK_SIZE):
+    """
+    Retrains the popularity scaler and clustering in streaming passes over 'fact_video_metrics': the first fits the
+    StandardScaler, the next ones fit a MiniBatchKMeans on shuffled mini-batches of the scaled features until the
+    cluster centers stop moving.
+    :return: The new model version, or None if there is no data.
+    """
+    query = "SELECT view_count, like_count, comment_count FROM fact_video_metrics"
+
+    scaler = StandardScaler()
+    rows_seen = 0
+    for _, rows in stream_query(conn, query, chunk_size=chunk_size):
+        scaler.partial_fit(log_features(rows))
+        rows_seen += len(rows)
+    if rows_seen == 0:
+        logging.warning("No video metrics to train the popularity model on.")
+        return None
+    logging.info(f"Fitted popularity scaler on {rows_seen} videos.")
+
+    kmeans = MiniBatchKMeans(n_clusters=2, random_state=42, batch_size=KMEANS_BATCH_SIZE)
+    rng = np.random.default_rng(42)
+    for epoch in range(1, KMEANS_MAX_EPOCHS + 1):
+        previous_centers = kmeans.cluster_centers_.copy() if hasattr(kmeans, 'cluster_centers_') else None
+        for _, rows in stream_query(conn, query, chunk_size=chunk_size):
+            features = scaler.transform(log_features(rows))
+            rng.shuffle(features)
+            for start in range(0, len(features), KMEANS_BATCH_SIZE):
+                batch = features[start:start + KMEANS_BATCH_SIZE]
+                if len(batch) >= kmeans.n_clusters:
+                    kmeans.partial_fit(batch)
+        if not hasattr(kmeans, 'cluster_centers_'):
+            logging.warning("Too few videos to fit the popularity clustering.")
+            return None
+        if previous_centers is not None:
+            shift = np.max(np.linalg.norm(kmeans.cluster_centers_ - previous_centers, axis=1))
+            logging.info(f"Popularity clustering epoch {epoch}: centers moved {shift:.6f}.")
+            if shift <= KMEANS_TOLERANCE:
+                break
+    logging.info(f"Fitted popularity clustering in {epoch} epochs.")
+
+    return save_artifacts('popularity', {'scaler.pkl': scaler, 'kmeans.pkl': kmeans}, {
+        'rows': rows_seen,
+        'features': ['log_views', 'log_likes', 'log_comments'],
+        'cluster_centers': kmeans.cluster_centers_.tolist(),
+        'epochs': epoch,
+    })
+
+
+def create_sentiment_labels_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sentiment_labels (
+            video_id TEXT PRIMARY KEY,
+            label TEXT NOT NULL
+        );
+    """)
+    cursor.connection.commit()
+
+
+def is_holdout(key):
+    return zlib.crc32(key.encode()) % 10 == HOLDOUT_BUCKET
+
+
+def read_labels_csv(labels_csv, chunk_size=CHUNK_SIZE):
+    """
+    Streams a labelled CSV like the 'studentset.csv' of the sentiment notebook, with the same cleaning: column
+    names are stripped and lower-cased, a combined 'transcript,label' column is split on its first comma, rows
+    without a transcript or label are dropped, and every label containing 'positive' is positive.
+    :return: Generator of lists of (holdout key, transcript, positive) tuples. The transcript is the holdout key,
+        since the rows have no video ID.
+    """
+    for data in pd.read_csv(labels_csv, delimiter=';', on_bad_lines='warn', chunksize=chunk_size):
+        data = data.rename(columns=lambda x: x.strip().lower())
+        if 'transcript,label' in data.columns:
+            split_columns = data['transcript,label'].str.split(',', n=1, expand=True)
+            if split_columns.shape[1] == 2:
+                data[['transcript', 'label']] = split_columns
+            data = data.drop(columns=['transcript,label'])
+        if 'transcript' not in data.columns or 'label' not in data.columns:
+            raise ValueError(f"{labels_csv} needs a 'transcript' and a 'label' column.")
+        data = data.dropna(subset=['transcript', 'label'])
+        yield [(transcript, transcript, 'positive' in label.lower())
+               for transcript, label in zip(data['transcript'].astype(str), data['label'].astype(str))]
+
+
+def labelled_transcripts(conn, labels_csv=None, chunk_size=CHUNK_SIZE):
+    """
+    Streams all labelled transcripts: the stored transcripts of the videos in 'sentiment_labels', followed by the
+    rows of 'labels_csv' when given.
+    :return: Generator of lists of (holdout key, transcript, positive) tuples.
+    """
+    query = """
+        SELECT t.video_id, t.transcript, LOWER(l.label) LIKE '%positive%'
+        FROM sentiment_labels l
+        JOIN dim_transcripts t ON t.video_id = l.video_id
+        WHERE t.transcript <> ''
+    """
+    for _, rows in stream_query(conn, query, chunk_size=chunk_size):
+        yield rows
+    if labels_csv:
+        yield from read_labels_csv(labels_csv, chunk_size)
+
+
+def count_correct(classifier, vectorizer, rows):
+    predictions = classifier.predict(vectorizer.transform([row[1] for row in rows]))
+    return int(np.sum(predictions == np.array([int(row[2]) for row in rows])))
+
+
+def train_sentiment_model(conn, chunk_size=CHUNK_SIZE, labels_csv=SENTIMENT_LABELS_CSV):
+    """
+    Retrains the sentiment classifier on the labelled transcripts. Labels come from two sources: 'sentiment_labels'
+    (video ID and label, joined with the stored transcripts in 'dim_transcripts'), and a labelled CSV such as the
+    'studentset.csv' the notebook model was trained on ('labels_csv', or SENTIMENT_LABELS_CSV).
+    Transcripts are streamed in chunks and hashed, so no vocabulary has to be fitted or kept in memory, and the
+    Naive Bayes classifier of the notebook is trained incrementally with partial_fit. Classes are weighted by their
+    frequency instead of oversampled.
+    :return: The new model version, or None if there are no labelled transcripts.
+    """
+    with conn.cursor() as cursor:
+        create_sentiment_labels_table(cursor)
+
+    class_counts = {}
+    for rows in labelled_transcripts(conn, labels_csv, chunk_size):
+        for row in rows:
+            class_counts[int(row[2])] = class_counts.get(int(row[2]), 0) + 1
+    if len(class_counts) < 2:
+        logging.warning(f"Need labelled transcripts of both classes to train the sentiment model, got {class_counts}.")
+        return None
+
+    total = sum(class_counts.values())
+    class_weights = {label: total / (2 * count) for label, count in class_counts.items()}
+
+    vectorizer = HashingVectorizer(ngram_range=(1, 2), n_features=HASHING_FEATURES, alternate_sign=False,
+                                   norm='l2')
+    classifier = MultinomialNB()
+
+    trained_rows = 0
+    for rows in labelled_transcripts(conn, labels_csv, chunk_size):
+        train_rows = [row for row in rows if not is_holdout(row[0])]
+        if not train_rows:
+            continue
+        labels = np.array([int(row[2]) for row in train_rows])
+        classifier.partial_fit(vectorizer.transform([row[1] for row in train_rows]), labels, classes=[0, 1],
+                               sample_weight=np.array([class_weights[label] for label in labels]))
+        trained_rows += len(train_rows)
+        logging.info(f"Trained sentiment model on {trained_rows} transcripts so far.")
+
+    if not trained_rows:
+        logging.warning("All labelled transcripts fell in the holdout set, not training the sentiment model.")
+        return None
+
+    # Second pass to evaluate the final model on the held-out transcripts
+    holdout_rows, holdout_correct = 0, 0
+    for rows in labelled_transcripts(conn, labels_csv, chunk_size):
+        rows = [row for row in rows if is_holdout(row[0])]
+        if rows:
+            holdout_correct += count_correct(classifier, vectorizer, rows)
+            holdout_rows += len(rows)
+    accuracy = holdout_correct / holdout_rows if holdout_rows else None
+    logging.info(f"Trained sentiment model on {trained_rows} transcripts, holdout accuracy: {accuracy}.")
+
+    return save_artifacts('sentiment', {'sentiment_model.pkl': classifier, 'vectorizer.pkl': vectorizer}, {
+        'rows': trained_rows,
+        'holdout_rows': holdout_rows,
+        'holdout_accuracy': accuracy,
+        'class_counts': {'negative': class_counts.get(0, 0), 'positive': class_counts.get(1, 0)},
+        'labels_csv': labels_csv,
+    })
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Retrain the popularity and sentiment models on production data.")
+    parser.add_argument('--only', choices=['popularity', 'sentiment'], help="Retrain only this model.")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help="Rows streamed from PostgreSQL per chunk.")
+    parser.add_argument('--labels-csv', default=SENTIMENT_LABELS_CSV,
+                        help="';'-delimited CSV with transcript and label columns (like the notebook's "
+                             "studentset.csv) to train the sentiment model on, next to 'sentiment_labels'.")
+    args = parser.parse_args()
+
+    conn = connect_to_postgres()
+    if not conn:
+        logging.error("Failed to connect to PostgreSQL.")
+        exit(1)
+
+    try:
+        if args.only in (None, 'popularity'):
+            train_popularity_model(conn, args.chunk_size)
+        if args.only in (None, 'sentiment'):
+            train_sentiment_model(conn, args.chunk_size, args.labels_csv)
+    finally:
+        close_connection(conn)
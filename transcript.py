@@ -1,24 +1,63 @@
 from youtube_transcript_api import YouTubeTranscriptApi
+import concurrent.futures
 import logging
 
+# Failure reasons by youtube_transcript_api exception name. Matching on names keeps this working across library
+# versions, which renamed and added several exceptions (e.g. TooManyRequests became RequestBlocked/IpBlocked).
+TRANSCRIPT_ERROR_REASONS = {
+    'TranscriptsDisabled': 'disabled',
+    'NoTranscriptFound': 'disabled',
+    'NoTranscriptAvailable': 'disabled',
+    'VideoUnavailable': 'unavailable',
+    'InvalidVideoId': 'unavailable',
+    'AgeRestricted': 'unavailable',
+    'VideoUnplayable': 'unavailable',
+    'TooManyRequests': 'throttled',
+    'RequestBlocked': 'throttled',
+    'IpBlocked': 'throttled',
+}
 
-def fetch_transcript_for_videos(video_ids):
+
+def classify_transcript_error(error):
+    """
+    Maps a transcript fetch exception to a failure reason: 'disabled', 'unavailable', 'throttled' or 'error'.
+    """
+    for error_class in type(error).__mro__:
+        if error_class.__name__ in TRANSCRIPT_ERROR_REASONS:
+            return TRANSCRIPT_ERROR_REASONS[error_class.__name__]
+    return 'error'
+
+
+def fetch_transcript(video_id):
+    transcript_data = YouTubeTranscriptApi.get_transcript(video_id)
+    return ' '.join([entry['text'] for entry in transcript_data])
+
+
+def fetch_transcripts(video_ids, max_workers=10):
     """
-    Fetches transcripts for a list of YouTube video IDs.
+    Fetches transcripts concurrently and keeps track of why fetches failed. A transcript without any text counts
+    as 'disabled', so it goes to the negative cache instead of being stored empty and fetched again on every run.
     :param video_ids: List of video IDs.
-    :return: Dictionary of video ID to transcript text.
+    :return: Tuple of (dictionary of video ID to transcript text, dictionary of video ID to failure reason).
     """
     transcripts = {}
+    failures = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_video = {executor.submit(fetch_transcript, video_id): video_id for video_id in video_ids}
+        for future in concurrent.futures.as_completed(future_to_video):
+            video_id = future_to_video[future]
+            try:
+                transcript = future.result()
+            except Exception as e:
+                failures[video_id] = classify_transcript_error(e)
+                logging.warning(f"No transcript for video {video_id} ({failures[video_id]}): {type(e).__name__}")
+                continue
+            if transcript.strip():
+                transcripts[video_id] = transcript
+            else:
+                failures[video_id] = 'disabled'
+                logging.warning(f"No transcript for video {video_id} (disabled): transcript is empty")
 
-    for video_id in video_ids:
-        try:
-            logging.info(f"Fetching transcript for video: {video_id}")
-            transcript_data = YouTubeTranscriptApi.get_transcript(video_id)
-            transcript_text = ' '.join([entry['text'] for entry in transcript_data])
-            transcripts[video_id] = transcript_text
-            logging.info(f"Successfully fetched transcript for video {video_id}.")
-        except Exception as e:
-            logging.error(f"Error fetching transcript for video {video_id}: {e}")
-            transcripts[video_id] = None
-
-    return transcripts
+    logging.info(f"Fetched {len(transcripts)} transcripts, {len(failures)} failed.")
+    return transcripts, failures
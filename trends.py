@@ -0,0 +1,194 @@
+import logging
+import os
+from datetime import datetime
+
+import psycopg2
+from dotenv import load_dotenv
+
+from connection import connect_to_postgres, close_connection, create_history_table
+
+# Load environment variables
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Windows (in days before now) the trends are computed over
+TREND_WINDOWS_DAYS = [int(days) for days in os.getenv('TREND_WINDOWS_DAYS', '7,30').split(',')]
+# A like or comment signals more engagement than a view, so they weigh more in the trending score
+LIKE_WEIGHT = 20.0
+COMMENT_WEIGHT = 50.0
+ACCELERATION_WEIGHT = 0.5
+REFRESH_BATCH_SIZE = 5000
+
+# Velocity is the least-squares slope of a metric over the snapshots in the window (per day). Acceleration is the
+# slope of the step velocities between consecutive snapshots (per day squared), computed with LAG. The trending
+# score is the log of the weighted engagement velocity, scaled up or down by how fast the view velocity changes.
+# Windows end at the anchor of the refresh that computed a row, taken from the same clock as 'snapshot_date' (the
+# ingesting process, not the database). A row keeps its anchor until the video gets a new snapshot or the row expires.
+REFRESH_TRENDS_QUERY = """
+    WITH points AS (
+        SELECT h.video_id, h.snapshot_date, h.view_count, h.like_count, h.comment_count,
+               (EXTRACT(EPOCH FROM h.snapshot_date - %(anchor)s::timestamp) / 86400.0)::float8 AS age_days
+        FROM fact_video_metrics_history h
+        WHERE h.video_id = ANY(%(video_ids)s)
+          AND h.snapshot_date >= %(anchor)s::timestamp - make_interval(days => %(max_window)s)
+    ), windowed AS (
+        SELECT w.window_days, p.video_id, p.snapshot_date, p.age_days,
+               p.view_count, p.like_count, p.comment_count,
+               (p.view_count - LAG(p.view_count) OVER s) / NULLIF(p.age_days - LAG(p.age_days) OVER s, 0)
+                   AS view_step,
+               (p.like_count - LAG(p.like_count) OVER s) / NULLIF(p.age_days - LAG(p.age_days) OVER s, 0)
+                   AS like_step,
+               (p.comment_count - LAG(p.comment_count) OVER s) / NULLIF(p.age_days - LAG(p.age_days) OVER s, 0)
+                   AS comment_step,
+               (p.age_days + LAG(p.age_days) OVER s) / 2 AS step_age
+        FROM points p
+        JOIN unnest(%(windows)s::int[]) AS w(window_days) ON p.age_days >= -w.window_days
+        WINDOW s AS (PARTITION BY w.window_days, p.video_id ORDER BY p.snapshot_date)
+    ), trends AS (
+        SELECT video_id, window_days, COUNT(*) AS snapshots, MAX(snapshot_date) AS last_snapshot,
+               COALESCE(regr_slope(view_count, age_days), 0) AS view_velocity,
+               COALESCE(regr_slope(like_count, age_days), 0) AS like_velocity,
+               COALESCE(regr_slope(comment_count, age_days), 0) AS comment_velocity,
+               COALESCE(regr_slope(view_step, step_age), 0) AS view_acceleration,
+               COALESCE(regr_slope(like_step, step_age), 0) AS like_acceleration,
+               COALESCE(regr_slope(comment_step, step_age), 0) AS comment_acceleration
+        FROM windowed
+        GROUP BY video_id, window_days
+    )
+    INSERT INTO dim_trends (video_id, window_days, snapshots, last_snapshot, view_velocity, like_velocity,
+                            comment_velocity, view_acceleration, like_acceleration, comment_acceleration,
+                            trending_score, updated_at)
+    SELECT video_id, window_days, snapshots, last_snapshot, view_velocity, like_velocity, comment_velocity,
+           view_acceleration, like_acceleration, comment_acceleration,
+           LN(1 + GREATEST(view_velocity + %(like_weight)s * like_velocity
+                           + %(comment_weight)s * comment_velocity, 0))
+           * (1 + %(acceleration_weight)s * COALESCE(TANH(view_acceleration / NULLIF(ABS(view_velocity), 0)), 0)),
+           NOW()
+    FROM trends
+    ON CONFLICT (video_id, window_days) DO UPDATE SET
+        snapshots = EXCLUDED.snapshots,
+        last_snapshot = EXCLUDED.last_snapshot,
+        view_velocity = EXCLUDED.view_velocity,
+        like_velocity = EXCLUDED.like_velocity,
+        comment_velocity = EXCLUDED.comment_velocity,
+        view_acceleration = EXCLUDED.view_acceleration,
+        like_acceleration = EXCLUDED.like_acceleration,
+        comment_acceleration = EXCLUDED.comment_acceleration,
+        trending_score = EXCLUDED.trending_score,
+        updated_at = EXCLUDED.updated_at;
+"""
+
+# Rows whose last snapshot has fallen out of their window no longer show any growth, so they are zeroed instead of
+# keeping the score of the last time the video was refreshed.
+EXPIRE_TRENDS_QUERY = """
+    UPDATE dim_trends
+    SET snapshots = 0, view_velocity = 0, like_velocity = 0, comment_velocity = 0,
+        view_acceleration = 0, like_acceleration = 0, comment_acceleration = 0,
+        trending_score = 0, updated_at = NOW()
+    WHERE window_days = ANY(%(windows)s)
+      AND last_snapshot < %(anchor)s::timestamp - make_interval(days => window_days)
+      AND snapshots > 0;
+"""
+
+
+def create_trends_table(cursor):
+    """
+    Creates the table 'dim_trends' with the growth metrics and trending score per video and window.
+    """
+    try:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS dim_trends (
+                video_id TEXT NOT NULL,
+                window_days INT NOT NULL,
+                snapshots INT NOT NULL,
+                last_snapshot TIMESTAMP NOT NULL,
+                view_velocity DOUBLE PRECISION,
+                like_velocity DOUBLE PRECISION,
+                comment_velocity DOUBLE PRECISION,
+                view_acceleration DOUBLE PRECISION,
+                like_acceleration DOUBLE PRECISION,
+                comment_acceleration DOUBLE PRECISION,
+                trending_score DOUBLE PRECISION,
+                updated_at TIMESTAMP NOT NULL,
+                PRIMARY KEY (video_id, window_days)
+            );
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_trends_window_score
+            ON dim_trends (window_days, trending_score DESC);
+        """)
+        cursor.connection.commit()
+        logging.info("Table 'dim_trends' created or already exists.")
+    except psycopg2.Error as e:
+        logging.error(f"Error creating table 'dim_trends': {e}")
+        cursor.connection.rollback()
+
+
+def refresh_trends(cursor, video_ids, windows=None, anchor=None):
+    """
+    Recomputes the trends of the given videos, which should be the videos that got a new history snapshot, and
+    zeroes the trends of all videos without a snapshot in the window anymore.
+    All computation happens in the database, in batches of REFRESH_BATCH_SIZE videos.
+    :param anchor: End of the windows, on the clock the snapshots are written with; defaults to datetime.now(),
+        the clock main.save_video_metrics_to_history uses.
+    :return: Number of refreshed (video, window) rows.
+    """
+    video_ids = list(video_ids)
+    windows = windows or TREND_WINDOWS_DAYS
+    anchor = anchor or datetime.now()
+    refreshed_rows = 0
+    try:
+        cursor.execute(EXPIRE_TRENDS_QUERY, {'windows': windows, 'anchor': anchor})
+        if cursor.rowcount:
+            logging.info(f"Zeroed {cursor.rowcount} trend rows without snapshots in their window.")
+        if not video_ids:
+            cursor.connection.commit()
+            logging.info("No new snapshots, trends are up to date.")
+            return 0
+
+        for start in range(0, len(video_ids), REFRESH_BATCH_SIZE):
+            cursor.execute(REFRESH_TRENDS_QUERY, {
+                'video_ids': video_ids[start:start + REFRESH_BATCH_SIZE],
+                'windows': windows,
+                'anchor': anchor,
+                'max_window': max(windows),
+                'like_weight': LIKE_WEIGHT,
+                'comment_weight': COMMENT_WEIGHT,
+                'acceleration_weight': ACCELERATION_WEIGHT,
+            })
+            refreshed_rows += cursor.rowcount
+        cursor.connection.commit()
+        logging.info(f"Refreshed {refreshed_rows} trend rows for {len(video_ids)} videos over windows {windows}.")
+    except psycopg2.Error as e:
+        logging.error(f"Error refreshing trends: {e}")
+        cursor.connection.rollback()
+    return refreshed_rows
+
+
+def fetch_videos_with_new_snapshots(cursor):
+    """
+    Returns the videos with a history snapshot newer than the latest snapshot already reflected in 'dim_trends'.
+    """
+    cursor.execute("""
+        SELECT DISTINCT video_id
+        FROM fact_video_metrics_history
+        WHERE snapshot_date > COALESCE((SELECT MAX(last_snapshot) FROM dim_trends), '-infinity'::timestamp);
+    """)
+    return [row[0] for row in cursor.fetchall()]
+
+
+if __name__ == "__main__":
+    conn = connect_to_postgres()
+    if not conn:
+        logging.error("Failed to connect to PostgreSQL.")
+        exit()
+
+    try:
+        cursor = conn.cursor()
+        create_history_table(cursor)
+        create_trends_table(cursor)
+        refresh_trends(cursor, fetch_videos_with_new_snapshots(cursor))
+        cursor.close()
+    finally:
+        close_connection(conn)
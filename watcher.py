@@ -0,0 +1,337 @@
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import select
+import struct
+import time
+
+import psycopg2
+from dotenv import load_dotenv
+
+from audit import drop_expired_audit_partitions
+from connection import connect_to_postgres, close_connection
+from main import VIDEO_IDS_DIRECTORY, ingest_videos, list_video_ids
+
+# Load environment variables
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Kept outside the drop directory: writing it there would change the directory mtime used to skip rescans.
+MANIFEST_PATH = os.getenv('INGEST_MANIFEST', 'state/ingested_ids')
+BATCH_WINDOW_SECONDS = float(os.getenv('INGEST_BATCH_WINDOW', '5'))
+MAX_BATCH_SIZE = int(os.getenv('INGEST_MAX_BATCH', '200'))
+POLL_INTERVAL_SECONDS = float(os.getenv('INGEST_POLL_INTERVAL', '10'))
+REFRESH_INTERVAL_SECONDS = float(os.getenv('INGEST_REFRESH_INTERVAL', str(24 * 60 * 60)))
+# Backoff after a connection or database error, and before retrying a video that could not be fetched,
+# doubling up to the maximum
+RETRY_DELAY_SECONDS = 60
+MAX_RETRY_DELAY_SECONDS = 60 * 60
+# Videos that could not be fetched this many times (deleted videos, junk files) are left to the scheduled refresh
+MAX_INGEST_ATTEMPTS = 5
+
+# inotify constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class IngestManifest:
+    """
+    Persisted set of already ingested video IDs. IDs are appended one per line, so recording a batch costs one
+    small write regardless of how many IDs were ingested before. A small state file next to it keeps the
+    modification time of the drop directory at the last full scan and the time of the last scheduled refresh.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.state_path = path + '.state'
+        self.ids = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.ids = {line.strip() for line in f if line.strip()}
+        self.state = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                self.state = json.load(f)
+
+    def add(self, video_ids):
+        new_ids = [video_id for video_id in video_ids if video_id not in self.ids]
+        if not new_ids:
+            return
+        with open(self.path, 'a') as f:
+            f.write(''.join(f"{video_id}\n" for video_id in new_ids))
+            f.flush()
+            os.fsync(f.fileno())
+        self.ids.update(new_ids)
+
+    def save_state(self, **values):
+        self.state.update(values)
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.state_path)
+
+
+class InotifyWatcher:
+    """
+    Reports files that are closed after writing or moved into a directory, using the Linux inotify API.
+    """
+
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch failed for {directory}")
+
+    def read_events(self, timeout):
+        """
+        Waits up to 'timeout' seconds for events.
+        :return: Tuple of (list of file names, whether the kernel queue overflowed and events were lost).
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return [], False
+
+        names, overflowed = [], False
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return [], False
+
+        offset = 0
+        while offset < len(data):
+            _, mask, _, name_length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + name_length].rstrip(b'\0')
+            offset += name_length
+            if mask & IN_Q_OVERFLOW:
+                overflowed = True
+            elif name:
+                names.append(os.fsdecode(name))
+        return names, overflowed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """
+    Fallback for platforms or filesystems without inotify: rescans the directory with scandir, but only when its
+    modification time changed since the previous scan.
+    """
+
+    def __init__(self, directory, interval=POLL_INTERVAL_SECONDS):
+        self.directory = directory
+        self.interval = interval
+        self.last_mtime_ns = os.stat(directory).st_mtime_ns
+
+    def read_events(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        mtime_ns = os.stat(self.directory).st_mtime_ns
+        if mtime_ns == self.last_mtime_ns:
+            return [], False
+        self.last_mtime_ns = mtime_ns
+        with os.scandir(self.directory) as entries:
+            return [entry.name for entry in entries if entry.is_file()], False
+
+    def close(self):
+        pass
+
+
+def create_watcher(directory):
+    try:
+        watcher = InotifyWatcher(directory)
+        logging.info(f"Watching {directory} with inotify.")
+        return watcher
+    except (OSError, AttributeError) as e:
+        logging.warning(f"inotify is not available ({e}), falling back to polling {directory}.")
+        return PollingWatcher(directory)
+
+
+def video_id_from_filename(filename):
+    if filename.startswith('.'):
+        return None
+    return filename.split('.')[0]
+
+
+class IngestDaemon:
+    """
+    Long-running ingestion of the drop directory. New video IDs are collected into micro-batches and ingested
+    within BATCH_WINDOW_SECONDS of their arrival; all known IDs are refreshed every REFRESH_INTERVAL_SECONDS.
+    """
+
+    def __init__(self, directory=VIDEO_IDS_DIRECTORY, manifest_path=MANIFEST_PATH):
+        self.directory = directory
+        self.manifest = IngestManifest(manifest_path)
+        self.pending = set()
+        self.pending_since = None
+        self.scan_mtime_ns = None
+        self.conn = None
+        self.attempts = {}
+        self.not_before = {}
+        self.failed_batches = 0
+        self.retry_at = 0
+
+    def queue(self, filenames):
+        for filename in filenames:
+            video_id = video_id_from_filename(filename)
+            if video_id and video_id not in self.manifest.ids and video_id not in self.pending:
+                if not self.pending:
+                    self.pending_since = time.monotonic()
+                self.pending.add(video_id)
+
+    def catch_up(self):
+        """
+        Queues files that arrived while the daemon was not running. The directory listing is skipped entirely when
+        the directory has not changed since the last completed scan, so startup does not scale with its size.
+        """
+        mtime_ns = os.stat(self.directory).st_mtime_ns
+        if self.manifest.state.get('directory_mtime_ns') == mtime_ns:
+            logging.info("Drop directory unchanged since the last scan, skipping catch-up scan.")
+            return
+        self.queue(list_video_ids(self.directory))
+        logging.info(f"Catch-up scan queued {len(self.pending)} new video IDs.")
+        if self.pending:
+            self.scan_mtime_ns = mtime_ns
+        else:
+            self.manifest.save_state(directory_mtime_ns=mtime_ns)
+
+    def connection(self):
+        if self.conn is None or self.conn.closed:
+            self.conn = connect_to_postgres()
+        return self.conn
+
+    def ingest(self, video_ids):
+        """
+        :return: Set of the video IDs that were actually fetched and written, or None on a connection or database
+            error. An empty set means the YouTube API was reached but returned none of the videos.
+        """
+        conn = self.connection()
+        if not conn:
+            logging.error("Failed to connect to PostgreSQL, will retry on the next batch.")
+            return None
+        try:
+            result = ingest_videos(conn, list(video_ids))
+        except psycopg2.Error as e:
+            logging.error(f"Database error: {e}")
+            conn.rollback()
+            return None
+        if result['videos'].empty:
+            return set()
+        return set(result['videos']['Video ID']) & set(video_ids)
+
+    def backing_off(self):
+        return time.monotonic() < self.retry_at
+
+    def retry_delay(self, failures):
+        return min(RETRY_DELAY_SECONDS * 2 ** (failures - 1), MAX_RETRY_DELAY_SECONDS)
+
+    def record_outcome(self, succeeded):
+        if succeeded:
+            self.failed_batches = 0
+            self.retry_at = 0
+            return
+        self.failed_batches += 1
+        delay = self.retry_delay(self.failed_batches)
+        self.retry_at = time.monotonic() + delay
+        logging.warning(f"Could not reach the database, retrying in {delay} seconds.")
+
+    def flush(self, force=False):
+        if not self.pending or self.backing_off():
+            return
+        waited = time.monotonic() - self.pending_since
+        if not force and waited < BATCH_WINDOW_SECONDS and len(self.pending) < MAX_BATCH_SIZE:
+            return
+
+        now = time.monotonic()
+        batch = [video_id for video_id in sorted(self.pending) if self.not_before.get(video_id, 0) <= now]
+        batch = batch[:MAX_BATCH_SIZE]
+        if not batch:
+            return
+        logging.info(f"Ingesting micro-batch of {len(batch)} new video IDs.")
+        ingested = self.ingest(batch)
+        self.record_outcome(ingested is not None)
+        if ingested is None:
+            return
+
+        # Every ID of the batch reached the API; the ones it did not return are retried later, a few times
+        done = set(ingested)
+        for video_id in set(batch) - ingested:
+            self.attempts[video_id] = self.attempts.get(video_id, 0) + 1
+            if self.attempts[video_id] >= MAX_INGEST_ATTEMPTS:
+                logging.warning(f"Video {video_id} could not be fetched after {MAX_INGEST_ATTEMPTS} attempts, "
+                                f"leaving it to the scheduled refresh.")
+                done.add(video_id)
+            else:
+                self.not_before[video_id] = now + self.retry_delay(self.attempts[video_id])
+        for video_id in done:
+            self.attempts.pop(video_id, None)
+            self.not_before.pop(video_id, None)
+
+        self.manifest.add(sorted(done))
+        self.pending.difference_update(done)
+        self.pending_since = time.monotonic() if self.pending else None
+        if not self.pending and self.scan_mtime_ns is not None:
+            self.manifest.save_state(directory_mtime_ns=self.scan_mtime_ns)
+            self.scan_mtime_ns = None
+
+    def refresh_due(self):
+        if self.backing_off():
+            return False
+        return time.time() - self.manifest.state.get('last_refresh', 0) >= REFRESH_INTERVAL_SECONDS
+
+    def refresh(self):
+        """
+        Re-ingests all recorded video IDs and applies audit retention. Runs independently of pending IDs, so videos
+        waiting for a retry never hold it up.
+        """
+        if self.manifest.ids:
+            logging.info(f"Running scheduled refresh of {len(self.manifest.ids)} ingested video IDs.")
+            ingested = self.ingest(sorted(self.manifest.ids))
+            self.record_outcome(ingested is not None)
+            if ingested is None:
+                return
+        self.manifest.save_state(last_refresh=time.time())
+
+        conn = self.connection()
+        if conn:
+            with conn.cursor() as cursor:
+                drop_expired_audit_partitions(cursor)
+
+    def run(self):
+        watcher = create_watcher(self.directory)
+        try:
+            self.catch_up()
+            while True:
+                timeout = BATCH_WINDOW_SECONDS if self.pending else POLL_INTERVAL_SECONDS
+                filenames, overflowed = watcher.read_events(timeout)
+                if overflowed:
+                    logging.warning("inotify queue overflowed, rescanning the drop directory.")
+                    self.manifest.state.pop('directory_mtime_ns', None)
+                    self.catch_up()
+                self.queue(filenames)
+                self.flush()
+                if self.refresh_due():
+                    self.refresh()
+        finally:
+            watcher.close()
+            close_connection(self.conn)
+
+
+if __name__ == "__main__":
+    if not os.path.exists(VIDEO_IDS_DIRECTORY):
+        logging.error(f"The directory {VIDEO_IDS_DIRECTORY} does not exist.")
+        exit()
+
+    IngestDaemon().run()